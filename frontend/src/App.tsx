@@ -10,10 +10,11 @@ export type MessageDict = {
   text: string;
   role: string;
   type: string;
+  blob?: boolean;
 };
 
 function App() {
-  const COMMANDS = ["reset"];
+  const COMMANDS = ["reset", "interrupt", "checkpoint", "restore"];
 
   let [MODELS, setModels] = useState([{displayName: "GPT-3.5", name: "gpt-3.5-turbo"}]);
 
@@ -46,7 +47,7 @@ function App() {
         type: "message",
       },
       {
-        text: "If I get stuck just type 'reset' and I'll restart the kernel.",
+        text: "If I get stuck just type 'interrupt' to stop the running code, or 'reset' and I'll restart the kernel. Type 'checkpoint' to save your variables and 'restore' to get them back after a restart.",
         role: "generator",
         type: "message",
       },
@@ -58,7 +59,7 @@ function App() {
   const chatScrollRef = React.useRef<HTMLDivElement>(null);
 
   const submitCode = async (code: string) => {
-    fetch(`${Config.API_ADDRESS}/api`, {
+    fetch(`${Config.API_ADDRESS}/api?session=${Config.SESSION_ID}`, {
       method: "POST",
       headers: {
         "Content-Type": "application/json",
@@ -75,11 +76,31 @@ function App() {
     });
   };
 
+  const replaceMessage = (previous: MessageDict, message: MessageDict) => {
+    setMessages((state: Array<MessageDict>) => {
+      return state.map((m) => (m === previous ? message : m));
+    });
+  };
+
   const handleCommand = (command: string) => {
     if (command == "reset") {
       addMessage({ text: "Restarting the kernel.", type: "message", role: "system" });
+      setWaitingForSystem(WaitingStates.Idle);
+
+      fetch(`${Config.API_ADDRESS}/restart?session=${Config.SESSION_ID}`, {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+        },
+        body: JSON.stringify({}),
+      })
+        .then(() => {})
+        .catch((error) => console.error("Error:", error));
+    } else if (command == "interrupt") {
+      // The kernel keeps its variables, the cell's done status sets us back to idle
+      addMessage({ text: "Interrupting the running code.", type: "message", role: "system" });
 
-      fetch(`${Config.API_ADDRESS}/restart`, {
+      fetch(`${Config.API_ADDRESS}/interrupt?session=${Config.SESSION_ID}`, {
         method: "POST",
         headers: {
           "Content-Type": "application/json",
@@ -88,6 +109,24 @@ function App() {
       })
         .then(() => {})
         .catch((error) => console.error("Error:", error));
+    } else if (command == "checkpoint" || command == "restore") {
+      // Runs as a cell in the kernel, which reports what was saved or restored
+      setWaitingForSystem(WaitingStates.RunningCode);
+
+      fetch(`${Config.API_ADDRESS}/${command}?session=${Config.SESSION_ID}`, {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+        },
+        body: JSON.stringify({}),
+      })
+        .then(async (response) => {
+          if (!response.ok) {
+            addMessage({ text: (await response.json()).error, type: "message", role: "system" });
+            setWaitingForSystem(WaitingStates.Idle);
+          }
+        })
+        .catch((error) => console.error("Error:", error));
     }
   };
 
@@ -105,7 +144,7 @@ function App() {
       addMessage({ text: userInput, type: "message", role: "user" });
       setWaitingForSystem(WaitingStates.GeneratingCode);
 
-      const response = await fetch(`${Config.WEB_ADDRESS}/generate`, {
+      const response = await fetch(`${Config.WEB_ADDRESS}/generate-stream?session=${Config.SESSION_ID}`, {
         method: "POST",
         headers: {
           "Content-Type": "application/json",
@@ -117,20 +156,63 @@ function App() {
         }),
       });
 
-      const data = await response.json();
-      const code = data.code;
+      // The answer arrives as newline delimited JSON events, show the text as it
+      // streams in and run the code as soon as its block is complete
+      let message: MessageDict = { text: "", type: "message", role: "generator" };
+      addMessage(message);
 
-      addMessage({ text: data.text, type: "message", role: "generator" });
+      const showText = (text: string) => {
+        const previous = message;
+        message = { ...message, text: text };
+        replaceMessage(previous, message);
+      };
 
-      if (response.status != 200) {
-        setWaitingForSystem(WaitingStates.Idle);
-        return;
+      let text = "";
+      let submitted = false;
+      const runCode = (code: string) => {
+        if (!submitted) {
+          submitted = true;
+          submitCode(code);
+          setWaitingForSystem(WaitingStates.RunningCode);
+        }
+      };
+
+      const reader = response.body!.getReader();
+      const decoder = new TextDecoder();
+      let buffered = "";
+
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) {
+          break;
+        }
+
+        buffered += decoder.decode(value, { stream: true });
+        const lines = buffered.split("\n");
+        buffered = lines.pop()!;
+
+        for (const line of lines) {
+          if (line.length == 0) {
+            continue;
+          }
+
+          const event = JSON.parse(line);
+          if (event.type == "text") {
+            text += event.value;
+            showText(text);
+          } else if (event.type == "code") {
+            runCode(event.value);
+          } else if (event.type == "done") {
+            showText(event.text);
+
+            if (event.status == 200 && !!event.code) {
+              runCode(event.code);
+            }
+          }
+        }
       }
-      
-      if (!!code) {
-        submitCode(code);
-        setWaitingForSystem(WaitingStates.RunningCode);
-      } else {
+
+      if (!submitted) {
         setWaitingForSystem(WaitingStates.Idle);
       }
     } catch (error) {
@@ -141,21 +223,35 @@ function App() {
     }
   };
 
+  function handleResult(result: {value: string, type: string, blob?: boolean}) {
+    // Status updates aren't shown, the code keeps running until its execution is done
+    if (result.type == "status") {
+      if (result.value == "done") {
+        setWaitingForSystem(WaitingStates.Idle);
+      }
+      return;
+    }
+
+    // Profiler reports of cells run with the profile flag, kept by /executions
+    if (result.type == "profile") {
+      return;
+    }
+
+    if (result.value.trim().length == 0) {
+      return;
+    }
+
+    addMessage({ text: result.value, type: result.type, role: "system", blob: result.blob });
+  }
+
   async function getApiData() {
     if(document.hidden){
       return;
     }
     
-    let response = await fetch(`${Config.API_ADDRESS}/api`);
+    let response = await fetch(`${Config.API_ADDRESS}/api?session=${Config.SESSION_ID}`);
     let data = await response.json();
-    data.results.forEach(function (result: {value: string, type: string}) {
-      if (result.value.trim().length == 0) {
-        return;
-      }
-
-      addMessage({ text: result.value, type: result.type, role: "system" });
-      setWaitingForSystem(WaitingStates.Idle);
-    });
+    data.results.forEach(handleResult);
   }
 
   function completeUpload(message: string) {
@@ -163,7 +259,7 @@ function App() {
     setWaitingForSystem(WaitingStates.Idle);
 
     // Inform prompt server
-    fetch(`${Config.WEB_ADDRESS}/inject-context`, {
+    fetch(`${Config.WEB_ADDRESS}/inject-context?session=${Config.SESSION_ID}`, {
       method: "POST",
       headers: {
         "Content-Type": "application/json",
@@ -181,9 +277,38 @@ function App() {
   }
 
   React.useEffect(() => {
-    const interval = setInterval(getApiData, 1000);
-    return () => clearInterval(interval);
-  }, [getApiData]);
+    // Results are pushed over Server-Sent Events, polling is only used
+    // when the stream can't be established at all
+    let interval: ReturnType<typeof setInterval> | undefined;
+    let opened = false;
+
+    // After a reload, continue after the last result this tab got, so the
+    // results sent while the page was gone aren't lost
+    const lastEventId = sessionStorage.getItem("lastEventId");
+    const after = lastEventId ? `&after=${lastEventId}` : "";
+    const source = new EventSource(`${Config.API_ADDRESS}/stream?session=${Config.SESSION_ID}${after}`);
+    source.onopen = () => {
+      opened = true;
+    };
+    source.onmessage = (event) => {
+      if (event.lastEventId) {
+        sessionStorage.setItem("lastEventId", event.lastEventId);
+      }
+      handleResult(JSON.parse(event.data));
+    };
+    source.onerror = () => {
+      // Once opened, EventSource reconnects by itself
+      if (!opened) {
+        source.close();
+        interval = interval ?? setInterval(getApiData, 1000);
+      }
+    };
+
+    return () => {
+      source.close();
+      clearInterval(interval);
+    };
+  }, []);
 
   React.useEffect(() => {
     // Scroll down container by setting scrollTop to the height of the container
@@ -5,6 +5,7 @@ import PersonIcon from "@mui/icons-material/Person";
 import TerminalIcon from '@mui/icons-material/Terminal';
 import FileUploadIcon from '@mui/icons-material/FileUpload';
 import { MessageDict } from "../App";
+import Config from "../config";
 
 import remarkGfm from 'remark-gfm';
 import SyntaxHighlighter from "react-syntax-highlighter";
@@ -15,10 +16,15 @@ function Message(props: {
   text: string;
   role: string;
   type: string;
+  blob?: boolean;
   showLoader?: boolean;
 }) {
   let { text, role } = props;
 
+  // Images are either inlined as base64 or referenced by their name in the blob store
+  const imageSource = (mimetype: string) =>
+    props.blob ? `${Config.WEB_ADDRESS}/blobs/${text}` : `data:${mimetype};base64,${text}`;
+
   const isMarkdown = (input: string) => {
     const mdRegex = /\[.*\]\(.*\)|\*\*.*\*\*|__.*__|\#.*|\!\[.*\]\(.*\)|`.*`|\- .*|\|.*\|/g;
     return mdRegex.test(input);
@@ -82,10 +88,13 @@ function Message(props: {
           ))}
         
         {props.type == "image/png" &&
-          <div className="cell-output-image" dangerouslySetInnerHTML={{ __html: `<img src='data:image/png;base64,${text}' />` }}></div>
+          <div className="cell-output-image" dangerouslySetInnerHTML={{ __html: `<img src='${imageSource("image/png")}' />` }}></div>
         }
         {props.type == "image/jpeg" &&
-          <div className="cell-output-image" dangerouslySetInnerHTML={{ __html: `<img src='data:image/jpeg;base64,${text}' />` }}></div>
+          <div className="cell-output-image" dangerouslySetInnerHTML={{ __html: `<img src='${imageSource("image/jpeg")}' />` }}></div>
+        }
+        {props.type == "image/gif" &&
+          <div className="cell-output-image" dangerouslySetInnerHTML={{ __html: `<img src='${imageSource("image/gif")}' />` }}></div>
         }
       </div>
     </div>
@@ -115,6 +124,7 @@ export default function Chat(props: {
               text={message.text}
               role={message.role}
               type={message.type}
+              blob={message.blob}
             />
           );
         })}
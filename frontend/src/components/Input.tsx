@@ -25,29 +25,63 @@ export default function Input(props: { onSendMessage: any, onStartUpload: any, o
     fileInputRef.current?.click();
   };
 
+  const uploadFile = async (file: File) => {
+    // Unfinished uploads of the same file are resumed from the last acknowledged chunk
+    const resumeKey = `upload:${file.name}:${file.size}:${file.lastModified}`;
+    let state: any = null;
+
+    const resumeId = localStorage.getItem(resumeKey);
+    if (resumeId !== null) {
+      const response = await fetch(`${Config.WEB_ADDRESS}/upload/${resumeId}`);
+      if (response.ok) {
+        state = await response.json();
+      }
+    }
+
+    if (state === null) {
+      const response = await fetch(Config.WEB_ADDRESS + "/upload/init", {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+        },
+        body: JSON.stringify({ filename: file.name, size: file.size }),
+      });
+      if (!response.ok) {
+        throw new Error("Network response was not ok");
+      }
+      state = await response.json();
+      localStorage.setItem(resumeKey, state.id);
+    }
+
+    for (let index = state.received; index < state.chunks; index++) {
+      const start = index * state.chunkSize;
+      const response = await fetch(`${Config.WEB_ADDRESS}/upload/${state.id}/${index}`, {
+        method: "PUT",
+        body: file.slice(start, start + state.chunkSize),
+      });
+      if (!response.ok) {
+        throw new Error("Network response was not ok");
+      }
+    }
+
+    const response = await fetch(`${Config.WEB_ADDRESS}/upload/${state.id}/complete`, {
+      method: "POST",
+    });
+    if (!response.ok) {
+      throw new Error("Network response was not ok");
+    }
+    localStorage.removeItem(resumeKey);
+    return response.json();
+  };
+
   const handleFileChange = async (e: any) => {
     if (e.target.files.length > 0) {
       const file = e.target.files[0];
 
-      // Create a new FormData instance
-      const formData = new FormData();
-
-      // Append the file to the form data
-      formData.append("file", file);
-
       props.onStartUpload(file.name);
 
       try {
-        const response = await fetch(Config.WEB_ADDRESS + "/upload", {
-          method: "POST",
-          body: formData,
-        });
-
-        if (!response.ok) {
-          throw new Error("Network response was not ok");
-        }
-
-        const json = await response.json();
+        const json = await uploadFile(file);
         props.onCompletedUpload(json["message"]);
 
       } catch (error) {
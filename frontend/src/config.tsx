@@ -1,8 +1,16 @@
 let resolvedWebAddress = import.meta.env.VITE_WEB_ADDRESS ? import.meta.env.VITE_WEB_ADDRESS : "";
 
+// Every browser tab gets its own kernel, identified by a per-tab session ID
+let sessionId = sessionStorage.getItem("sessionId");
+if (!sessionId) {
+    sessionId = crypto.randomUUID();
+    sessionStorage.setItem("sessionId", sessionId);
+}
+
 const Config = {
     WEB_ADDRESS: resolvedWebAddress,
-    API_ADDRESS: resolvedWebAddress + "/api"
+    API_ADDRESS: resolvedWebAddress + "/api",
+    SESSION_ID: sessionId
 }
 
 export default Config;
\ No newline at end of file
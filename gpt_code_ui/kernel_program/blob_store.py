@@ -0,0 +1,37 @@
+import os
+import re
+import hashlib
+
+import gpt_code_ui.kernel_program.config as config
+
+# Binary display data that is stored out of band instead of sent base64 encoded
+BLOB_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/gif": ".gif",
+}
+
+BLOB_NAME_RE = re.compile(r"^[0-9a-f]{64}\.[a-z]+$")
+
+
+def store_blob(data, mimetype):
+    """Write `data` to the content-addressed store once and return its name."""
+    name = hashlib.sha256(data).hexdigest() + BLOB_EXTENSIONS[mimetype]
+    path = blob_path(name)
+
+    if not os.path.isfile(path):
+        os.makedirs(config.BLOB_DIR, exist_ok=True)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    return name
+
+
+def blob_path(name):
+    return os.path.join(config.BLOB_DIR, name)
+
+
+def is_blob_name(name):
+    return BLOB_NAME_RE.match(name) is not None
@@ -0,0 +1,125 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+
+import gpt_code_ui.kernel_program.config as config
+import gpt_code_ui.kernel_program.kernel_checkpoint as kernel_checkpoint
+
+logger = config.get_logger()
+
+# Checkpoint names become directory names
+NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9_.-]{0,127}$")
+
+
+# Saved and restored when no name is given, and by idle checkpoints
+DEFAULT_NAME = "latest"
+
+
+def valid_name(name):
+    return bool(NAME_PATTERN.match(name)) and not name.endswith((".saving", kernel_checkpoint.PREVIOUS_SUFFIX))
+
+
+def session_dir(session):
+    # Named by a hash, the session ids can't be read off the checkpoint directory
+    return os.path.join(config.CHECKPOINT_DIR, hashlib.sha256(session.encode("utf-8")).hexdigest()[:32])
+
+
+def checkpoint_path(session, name):
+    # Absolute, the kernel runs in the workspace
+    return os.path.abspath(os.path.join(session_dir(session), name))
+
+
+def exists(session, name):
+    path = checkpoint_path(session, name)
+    return any(
+        os.path.isfile(os.path.join(candidate, kernel_checkpoint.MANIFEST))
+        for candidate in (path, path + kernel_checkpoint.PREVIOUS_SUFFIX)
+    )
+
+
+def save_code(session, name, quiet=False):
+    """Return the cell that checkpoints the kernel's namespace as the session's `name`."""
+    return "__import__(%r, fromlist=['save']).save(%r, quiet=%r)" % (
+        kernel_checkpoint.__name__, checkpoint_path(session, name), quiet)
+
+
+def restore_code(session, name):
+    return "__import__(%r, fromlist=['restore']).restore(%r)" % (
+        kernel_checkpoint.__name__, checkpoint_path(session, name))
+
+
+def list_checkpoints(session):
+    """Return the session's checkpoints, the most recent first."""
+    checkpoints = []
+    directory = session_dir(session)
+    if not os.path.isdir(directory):
+        return checkpoints
+
+    for entry in os.scandir(directory):
+        name = entry.name
+        if name.endswith(kernel_checkpoint.PREVIOUS_SUFFIX):
+            # Left behind by a save that stopped halfway, restoring puts it back
+            name = name[:-len(kernel_checkpoint.PREVIOUS_SUFFIX)]
+            if os.path.isdir(os.path.join(directory, name)):
+                continue
+        if not valid_name(name):
+            continue
+
+        try:
+            with open(os.path.join(entry.path, kernel_checkpoint.MANIFEST)) as f:
+                manifest = json.load(f)
+            size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+        except (OSError, ValueError):
+            continue
+        checkpoints.append({
+            "name": name,
+            "created_at": manifest["created_at"],
+            "variables": sorted(manifest["variables"]),
+            "skipped": manifest["skipped"],
+            "bytes": size,
+        })
+
+    checkpoints.sort(key=lambda c: c["created_at"], reverse=True)
+    return checkpoints
+
+
+class IdleCheckpoints:
+    """Checkpoints sessions once they have been idle for a while after running cells.
+
+    `checkpoint(session)` submits the checkpoint and returns whether it could,
+    it's tried again later when the session turned out to be busy.
+    """
+
+    def __init__(self, checkpoint, idle_seconds=config.KERNEL_IDLE_CHECKPOINT):
+        self.checkpoint = checkpoint
+        self.idle_seconds = idle_seconds
+        self.lock = threading.Lock()
+        self.changed = {}  # session -> time.monotonic() of its last finished cell
+
+    def start(self):
+        if self.idle_seconds > 0:
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def on_done(self, session):
+        with self.lock:
+            self.changed[session] = time.monotonic()
+
+    def forget(self, session):
+        with self.lock:
+            self.changed.pop(session, None)
+
+    def run(self):
+        while True:
+            time.sleep(min(5, self.idle_seconds))
+
+            now = time.monotonic()
+            with self.lock:
+                due = [session for session, at in self.changed.items() if now - at >= self.idle_seconds]
+
+            for session in due:
+                if self.checkpoint(session):
+                    logger.debug("Checkpointing idle session %s" % session)
+                    self.forget(session)
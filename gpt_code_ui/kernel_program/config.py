@@ -1,10 +1,90 @@
 import logging
 import os
+import tempfile
 
 IDENT_KERNEL_MANAGER = "kernel_manager"
 IDENT_MAIN = "main"
 KERNEL_PID_DIR = "process_pids"
+BLOB_DIR = os.path.join("workspace", ".blobs")
+CHECKPOINT_DIR = os.path.join("workspace", ".checkpoints")
 SNAKEMQ_PORT = int(os.environ.get("SNAKEMQ_PORT", 8765))
+API_PORT = int(os.environ.get("API_PORT", 5010))
+
+# Messaging between the kernel program and the kernel managers, "snakemq" or "zmq"
+KERNEL_TRANSPORT = os.environ.get("KERNEL_TRANSPORT", "snakemq")
+
+# Endpoint of the zmq transport, a Unix domain socket unless on Windows
+KERNEL_TRANSPORT_ADDRESS = os.environ.get(
+    "KERNEL_TRANSPORT_ADDRESS",
+    "tcp://127.0.0.1:%d" % (SNAKEMQ_PORT + 1) if os.name == "nt"
+    else "ipc://" + os.path.join(tempfile.gettempdir(), "gpt_code_ui_%d.sock" % SNAKEMQ_PORT),
+)
+
+# Connection files of the kernels, removed with them. They hold the kernels' keys, only the user may read them
+KERNEL_CONNECTION_DIR = os.environ.get(
+    "KERNEL_CONNECTION_DIR", os.path.join(tempfile.gettempdir(), "gpt_code_ui_kernels_%d" % API_PORT)
+)
+
+# Session used by clients that don't send one
+DEFAULT_SESSION = "default"
+
+# Number of started but unassigned kernels kept ready for new sessions
+KERNEL_POOL_SPARES = int(os.environ.get("KERNEL_POOL_SPARES", 1))
+
+# Seconds without requests after which a session's kernel is shut down, 0 to keep it forever
+KERNEL_SESSION_TIMEOUT = float(os.environ.get("KERNEL_SESSION_TIMEOUT", 3600))
+
+# Modules imported into every kernel before it's announced ready, comma separated
+KERNEL_PRELOAD_MODULES = [
+    m.strip() for m in os.environ.get("KERNEL_PRELOAD_MODULES", "numpy,pandas,matplotlib.pyplot").split(",")
+    if m.strip()
+]
+
+# Seconds between checks for kernel managers that exited
+KERNEL_CHECK_INTERVAL = float(os.environ.get("KERNEL_CHECK_INTERVAL", 2))
+
+# Seconds between keepalive comments on idle /stream connections
+STREAM_KEEPALIVE_INTERVAL = float(os.environ.get("STREAM_KEEPALIVE_INTERVAL", 15))
+
+# Seconds to keep collecting stream output after a first chunk before forwarding
+# it as one message, set to 0 to forward every chunk on its own
+IOPUB_COALESCE_WINDOW = float(os.environ.get("IOPUB_COALESCE_WINDOW", 0.02))
+
+# Bytes of text output forwarded per cell, the rest is dropped, 0 for no limit
+CELL_OUTPUT_MAX_BYTES = int(os.environ.get("CELL_OUTPUT_MAX_BYTES", 1024 * 1024))
+
+# Bytes of results held per session while no client fetches them, 0 for no limit
+RESULT_QUEUE_MAX_BYTES = int(os.environ.get("RESULT_QUEUE_MAX_BYTES", 8 * 1024 * 1024))
+
+# Number of executions whose state and timing can be queried
+EXECUTION_LOG_SIZE = int(os.environ.get("EXECUTION_LOG_SIZE", 1000))
+
+# Characters kept from both the start and the end of every execution's output,
+# the digest the webapp puts into the prompt
+EXECUTION_DIGEST_CHARS = int(os.environ.get("EXECUTION_DIGEST_CHARS", 300))
+
+# Bytes of memory a kernel may use, 0 for no limit. Enforced by the kernel's cgroup
+# when KERNEL_CGROUP_ROOT is set, as an address space rlimit otherwise
+KERNEL_MEMORY_LIMIT = int(os.environ.get("KERNEL_MEMORY_LIMIT", 0))
+
+# CPUs a kernel may use, e.g. 1.5, 0 for no limit. Needs KERNEL_CGROUP_ROOT
+KERNEL_CPU_LIMIT = float(os.environ.get("KERNEL_CPU_LIMIT", 0))
+
+# Writable cgroup v2 directory under which every kernel gets its own cgroup
+KERNEL_CGROUP_ROOT = os.environ.get("KERNEL_CGROUP_ROOT", "")
+
+# Resident memory in bytes at which the running cell is interrupted, 0 to never interrupt
+KERNEL_MEMORY_SOFT_LIMIT = int(os.environ.get("KERNEL_MEMORY_SOFT_LIMIT", 0))
+
+# Resident memory in bytes at which the kernel is restarted, 0 to never restart
+KERNEL_MEMORY_HARD_LIMIT = int(os.environ.get("KERNEL_MEMORY_HARD_LIMIT", 0))
+
+# Seconds between samples of the kernel's resident memory
+KERNEL_WATCHDOG_INTERVAL = float(os.environ.get("KERNEL_WATCHDOG_INTERVAL", 1))
+
+# Seconds a session has to be idle after running a cell before its namespace is
+# checkpointed automatically, 0 to only checkpoint on request
+KERNEL_IDLE_CHECKPOINT = float(os.environ.get("KERNEL_IDLE_CHECKPOINT", 0))
 
 
 def get_logger():
@@ -0,0 +1,128 @@
+import threading
+
+from collections import deque
+
+import gpt_code_ui.kernel_program.config as config
+
+logger = config.get_logger()
+
+
+class ExecutionQueue:
+    """Holds the cells of every session until its kernel is free.
+
+    Cells are handed to the kernel one at a time per session, the next one
+    once the previous is done. Queued cells can still be cancelled, unlike
+    those in the kernel's own queue. As with the kernel's stop_on_error, the
+    queued cells are aborted when a cell fails or is interrupted.
+    """
+
+    def __init__(self, dispatch, on_failed=None):
+        # dispatch(session, cell) sends a cell to the session's kernel
+        self.dispatch = dispatch
+        # on_failed(session, execution_id) reports a cell that couldn't be dispatched
+        self.on_failed = on_failed
+        self.lock = threading.Lock()
+        self.pending = {}  # session -> deque of cells, each a dict with an execution_id
+        self.running = {}  # session -> execution_id handed to the kernel
+
+    def submit(self, session, cell):
+        """Queue `cell`, return its position: 0 when it was dispatched right away."""
+        with self.lock:
+            if session not in self.running:
+                self.running[session] = cell["execution_id"]
+                position = 0
+            else:
+                self.pending.setdefault(session, deque()).append(cell)
+                position = len(self.pending[session])
+
+        if position == 0:
+            self.start(session, cell)
+        return position
+
+    def start(self, session, cell):
+        """Dispatch `cell`, or the next queued cells until one can be dispatched.
+
+        A cell that fails to dispatch would otherwise keep the session
+        marked as running and block its queue for good.
+        """
+        while cell is not None:
+            try:
+                self.dispatch(session, cell)
+                return
+            except Exception:
+                logger.exception("Error dispatching execution %s" % cell["execution_id"])
+
+            with self.lock:
+                if self.running.get(session) != cell["execution_id"]:
+                    return
+                del self.running[session]
+
+                failed, cell = cell, None
+                pending = self.pending.get(session)
+                if pending:
+                    cell = pending.popleft()
+                    self.running[session] = cell["execution_id"]
+                    if not pending:
+                        del self.pending[session]
+
+            if self.on_failed is not None:
+                self.on_failed(session, failed["execution_id"])
+
+    def position(self, session, execution_id):
+        """Return 0 for the running cell, its place in line for a queued one, None otherwise."""
+        with self.lock:
+            if self.running.get(session) == execution_id:
+                return 0
+            for position, cell in enumerate(self.pending.get(session, ()), 1):
+                if cell["execution_id"] == execution_id:
+                    return position
+        return None
+
+    def cancel(self, session, execution_id):
+        """Remove a queued cell, return whether it was still queued."""
+        with self.lock:
+            pending = self.pending.get(session, ())
+            for cell in pending:
+                if cell["execution_id"] == execution_id:
+                    pending.remove(cell)
+                    return True
+        return False
+
+    def on_done(self, session, execution_id, status):
+        """Dispatch the session's next cell, return the execution_ids aborted instead."""
+        aborted = []
+        next_cell = None
+        with self.lock:
+            if self.running.get(session) != execution_id:
+                return aborted
+            del self.running[session]
+
+            pending = self.pending.pop(session, deque())
+            if status in ("error", "aborted"):
+                aborted = [cell["execution_id"] for cell in pending]
+            elif pending:
+                next_cell = pending.popleft()
+                self.running[session] = next_cell["execution_id"]
+                if pending:
+                    self.pending[session] = pending
+
+        if next_cell is not None:
+            self.start(session, next_cell)
+        return aborted
+
+    def clear(self, session):
+        """Forget all cells of the session, whose kernel is gone. Return their execution_ids."""
+        with self.lock:
+            cleared = [cell["execution_id"] for cell in self.pending.pop(session, ())]
+            running = self.running.pop(session, None)
+        if running is not None:
+            cleared.insert(0, running)
+        return cleared
+
+    def busy(self, session):
+        with self.lock:
+            return session in self.running
+
+    def queued(self):
+        with self.lock:
+            return sum(len(pending) for pending in self.pending.values())
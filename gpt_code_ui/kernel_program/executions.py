@@ -0,0 +1,119 @@
+import time
+import uuid
+import threading
+
+from collections import OrderedDict
+
+import gpt_code_ui.kernel_program.config as config
+
+
+class ExecutionLog:
+    """Records the state and timing of the most recent executions."""
+
+    def __init__(self, max_records=config.EXECUTION_LOG_SIZE, digest_chars=config.EXECUTION_DIGEST_CHARS):
+        self.max_records = max_records
+        self.digest_chars = digest_chars
+        self.records = OrderedDict()  # execution_id -> record
+        self.lock = threading.Lock()
+
+    def submit(self, session, quiet=False):
+        """Start a record, `quiet` executions run without the client seeing their status."""
+        execution_id = uuid.uuid4().hex
+
+        with self.lock:
+            self.records[execution_id] = {
+                "execution_id": execution_id,
+                "session": session,
+                "state": "queued",
+                "status": None,
+                "submitted_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "queue_wait": None,
+                "run_time": None,
+                "output_bytes": 0,
+                "dropped_bytes": 0,
+                "profile": None,
+                "quiet": quiet,
+                "output_head": "",
+                "output_tail": "",
+                "images": 0,
+            }
+            while len(self.records) > self.max_records:
+                self.records.popitem(last=False)
+
+        return execution_id
+
+    def on_status(self, message):
+        """Update a record from a "running" or "done" status message of a kernel manager."""
+        with self.lock:
+            record = self.records.get(message.get("execution_id"))
+            if record is None:
+                return
+
+            if message["value"] == "running":
+                record["state"] = "running"
+                record["started_at"] = message["started_at"]
+            elif message["value"] == "done":
+                record["state"] = "done"
+                record["status"] = message["status"]
+                record["started_at"] = message["started_at"]
+                record["finished_at"] = message["finished_at"]
+                record["output_bytes"] = message["output_bytes"]
+                record["dropped_bytes"] = message["dropped_bytes"]
+
+            if record["started_at"] is not None:
+                record["queue_wait"] = record["started_at"] - record["submitted_at"]
+            if record["finished_at"] is not None and record["started_at"] is not None:
+                record["run_time"] = record["finished_at"] - record["started_at"]
+
+    def on_cancel(self, execution_id, status):
+        """Mark an execution that never got to run or whose kernel went away as done."""
+        with self.lock:
+            record = self.records.get(execution_id)
+            if record is not None and record["state"] != "done":
+                record["state"] = "done"
+                record["status"] = status
+                record["finished_at"] = time.time()
+
+    def on_output(self, message):
+        """Keep the start and the end of an execution's text output and count its images."""
+        with self.lock:
+            record = self.records.get(message.get("execution_id"))
+            if record is None:
+                return
+
+            if message["type"].startswith("image/"):
+                record["images"] += 1
+                return
+
+            text = message["value"]
+            room = self.digest_chars - len(record["output_head"])
+            if room > 0:
+                record["output_head"] += text[:room]
+                text = text[room:]
+            if text:
+                record["output_tail"] = (record["output_tail"] + text[-self.digest_chars:])[-self.digest_chars:]
+
+    def on_profile(self, message):
+        """Keep the profiler report of an execution that ran with profiling enabled."""
+        with self.lock:
+            record = self.records.get(message.get("execution_id"))
+            if record is not None:
+                record["profile"] = message["value"]
+
+    def is_quiet(self, execution_id):
+        with self.lock:
+            record = self.records.get(execution_id)
+            return record is not None and record["quiet"]
+
+    def get(self, execution_id):
+        with self.lock:
+            record = self.records.get(execution_id)
+            return dict(record) if record is not None else None
+
+    def list(self, session, limit=20):
+        """Return the latest records of `session`, newest first."""
+        with self.lock:
+            records = [dict(r) for r in reversed(self.records.values()) if r["session"] == session]
+        return records[:limit]
@@ -0,0 +1,142 @@
+# Runs inside the kernel: saves the user namespace to a checkpoint directory and loads it back
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import pickle
+
+try:
+    import cloudpickle
+except ImportError:
+    cloudpickle = None  # functions and classes defined in cells are skipped then
+
+MANIFEST = "manifest.json"
+
+# Where the earlier checkpoint is kept while a new one is swapped in
+PREVIOUS_SUFFIX = ".previous"
+
+# Names IPython puts into the namespace itself
+IGNORED_NAMES = {"In", "Out", "exit", "quit", "get_ipython"}
+
+
+def user_variables(shell):
+    hidden = shell.user_ns_hidden
+    for name, value in shell.user_ns.items():
+        if name.startswith("_") or name in IGNORED_NAMES or (name in hidden and hidden[name] is value):
+            continue
+        yield name, value
+
+
+def save_variable(directory, name, value):
+    """Write one variable, return its manifest entry."""
+    if isinstance(value, types.ModuleType):
+        return {"format": "module", "module": value.__name__}
+
+    # Columnar and memory-mappable formats for data, checked by module so neither is imported here
+    module = type(value).__module__.split(".")[0]
+    if module == "pandas" and type(value).__name__ == "DataFrame":
+        try:
+            value.to_parquet(os.path.join(directory, name + ".parquet"))
+            return {"format": "parquet", "file": name + ".parquet"}
+        except Exception:
+            # No pyarrow or fastparquet, or columns parquet can't hold, e.g. mixed types
+            pass
+    elif module == "numpy" and type(value).__name__ in ("ndarray", "memmap") and not value.dtype.hasobject:
+        import numpy
+        # Restored arrays are memmaps, saved as plain arrays again
+        numpy.save(os.path.join(directory, name + ".npy"), numpy.asarray(value), allow_pickle=False)
+        return {"format": "npy", "file": name + ".npy"}
+
+    with open(os.path.join(directory, name + ".pickle"), "wb") as f:
+        (cloudpickle or pickle).dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return {"format": "pickle", "file": name + ".pickle"}
+
+
+def load_variable(directory, entry):
+    if entry["format"] == "module":
+        __import__(entry["module"])
+        return sys.modules[entry["module"]]
+
+    path = os.path.join(directory, entry["file"])
+    if entry["format"] == "parquet":
+        import pandas
+        return pandas.read_parquet(path)
+    if entry["format"] == "npy":
+        import numpy
+        # Copy on write: only the pages that are used get read, and the array stays writable
+        return numpy.load(path, mmap_mode="c")
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def save(path, quiet=False):
+    """Save the user namespace to the directory `path`, replacing an earlier checkpoint there."""
+    from IPython import get_ipython
+
+    started = time.perf_counter()
+    # Written next to the old checkpoint and swapped in at the end, so a failure leaves it intact
+    staging = path + ".saving"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    variables = {}
+    skipped = {}
+    for name, value in list(user_variables(get_ipython())):
+        try:
+            variables[name] = save_variable(staging, name, value)
+        except Exception as e:
+            skipped[name] = "%s: %s" % (type(e).__name__, e)
+            for extension in (".parquet", ".npy", ".pickle"):
+                if os.path.exists(os.path.join(staging, name + extension)):
+                    os.remove(os.path.join(staging, name + extension))
+
+    with open(os.path.join(staging, MANIFEST), "w") as f:
+        json.dump({"created_at": time.time(), "variables": variables, "skipped": skipped}, f)
+
+    # Move the earlier checkpoint aside before swapping in the new one, so a
+    # crash in between leaves one of them in place
+    recover(path)
+    previous = path + PREVIOUS_SUFFIX
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.isdir(path):
+        os.rename(path, previous)
+    os.rename(staging, path)
+    shutil.rmtree(previous, ignore_errors=True)
+
+    if not quiet:
+        print("Saved %d variables in %.1fs%s" % (
+            len(variables), time.perf_counter() - started,
+            ", skipped %s" % ", ".join("%s (%s)" % item for item in skipped.items()) if skipped else "",
+        ))
+
+
+def recover(path):
+    """Put the checkpoint at `path` back in place if a save stopped halfway through swapping it."""
+    previous = path + PREVIOUS_SUFFIX
+    if not os.path.isdir(path) and os.path.isdir(previous):
+        os.rename(previous, path)
+
+
+def restore(path):
+    """Load the variables of the checkpoint at `path` into the user namespace."""
+    from IPython import get_ipython
+
+    started = time.perf_counter()
+    recover(path)
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+
+    shell = get_ipython()
+    failed = {}
+    for name, entry in manifest["variables"].items():
+        try:
+            shell.user_ns[name] = load_variable(path, entry)
+        except Exception as e:
+            failed[name] = "%s: %s" % (type(e).__name__, e)
+
+    print("Restored %d variables in %.1fs%s" % (
+        len(manifest["variables"]) - len(failed), time.perf_counter() - started,
+        ", failed %s" % ", ".join("%s (%s)" % item for item in failed.items()) if failed else "",
+    ))
@@ -3,51 +3,254 @@ import subprocess
 import os
 import queue
 import json
+import base64
 import signal
+import socket
 import pathlib
 import threading
 import time
-import atexit
+import uuid
 import traceback
 
 from time import sleep
-from jupyter_client import BlockingKernelClient
 
 from dotenv import load_dotenv
 load_dotenv('.env')
 
 import gpt_code_ui.kernel_program.utils as utils
 import gpt_code_ui.kernel_program.config as config
+import gpt_code_ui.kernel_program.transport as transport
+import gpt_code_ui.kernel_program.blob_store as blob_store
+import gpt_code_ui.kernel_program.kernel_profiler as kernel_profiler
+import gpt_code_ui.kernel_program.resource_limits as resource_limits
+import gpt_code_ui.metrics as metrics
 
 # Set up globals
 messaging = None
+shell_thread = None
+kernel_process = None
 logger = config.get_logger()
 
+# time.time() of every startup phase, reported with the ready status
+startup_times = {}
 
-class FlushingThread(threading.Thread):
-    def __init__(self, kc, kill_sema):
-        threading.Thread.__init__(self)
-        self.kill_sema = kill_sema
+# The control channel is shared by the threads that interrupt the kernel
+control_lock = threading.Lock()
+
+# Fields of the execute request a client may set, with their types. The others
+# are the kernel manager's, e.g. allow_stdin would block on input that never comes.
+EXECUTE_OPTIONS = {"store_history": bool, "stop_on_error": bool}
+
+# Options of kernel_profiler.arm a client may pass as the profile, with their types
+PROFILE_OPTIONS = {"cpu": bool, "memory": bool, "top": int}
+
+# Executions that haven't finished yet, keyed by the msg_id of their execute request
+executions = {}
+executions_lock = threading.Lock()
+
+
+class IOPubThread(threading.Thread):
+    """Forwards kernel output as soon as it is published on the iopub channel."""
+
+    def __init__(self, kc, coalesce_window=config.IOPUB_COALESCE_WINDOW):
+        threading.Thread.__init__(self, daemon=True)
         self.kc = kc
+        self.coalesce_window = coalesce_window
 
     def run(self):
-        logger.info("Running message flusher...")
+        logger.info("Running iopub reader...")
         while True:
+            # Blocks on the iopub socket, no wakeups while the kernel is quiet
+            flush_kernel_msgs(self.kc, coalesce_window=self.coalesce_window)
+
+
+class ShellThread(threading.Thread):
+    """Sends requests on the shell channel and handles the kernel's replies.
 
-            if self.kill_sema.acquire(blocking=False):
-                logger.info("Sema was released to kill thread")
-                sys.exit()
+    ZMQ sockets must not be used from several threads, so other threads hand
+    their requests over through a queue and wake this one up via a socket pair.
+    """
 
-            flush_kernel_msgs(self.kc)
-            time.sleep(1)
+    def __init__(self, kc):
+        threading.Thread.__init__(self, daemon=True)
+        self.kc = kc
+        self.requests = queue.Queue()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+
+    def send(self, msg):
+        self.requests.put(msg)
+        self.wakeup_send.send(b"\0")
+
+    def run(self):
+        import zmq
 
+        logger.info("Running shell channel thread...")
+        poller = zmq.Poller()
+        poller.register(self.kc.shell_channel.socket, zmq.POLLIN)
+        poller.register(self.wakeup_recv, zmq.POLLIN)
 
-def cleanup_spawned_processes():
-    print("Cleaning up kernels...")
+        while True:
+            ready = dict(poller.poll())
+
+            # Plain sockets are reported by their file descriptor
+            if self.wakeup_recv.fileno() in ready:
+                self.wakeup_recv.recv(4096)
+                while True:
+                    try:
+                        msg = self.requests.get_nowait()
+                    except queue.Empty:
+                        break
+                    self.kc.shell_channel.send(msg)
+
+            if self.kc.shell_channel.socket in ready:
+                while self.kc.shell_channel.msg_ready():
+                    try:
+                        handle_shell_msg(self.kc.get_shell_msg(timeout=0))
+                    except Exception as e:
+                        logger.debug(f"{e} [{type(e)}")
+
+
+class MemoryWatchdog(threading.Thread):
+    """Samples the kernel's resident memory and steps in when it grows too large.
+
+    Above the soft limit the running cell is interrupted, once per cell.
+    Cells stuck in C code may not notice the interrupt, so above the hard
+    limit the kernel is killed and the kernel program asked to restart it.
+    The same happens when the kernel was killed, by the OOM killer at its
+    cgroup's or the system's limit, or ran into its rlimit and died.
+    """
+
+    def __init__(self, process, ident, soft_limit=config.KERNEL_MEMORY_SOFT_LIMIT,
+                 hard_limit=config.KERNEL_MEMORY_HARD_LIMIT, memory_limit=config.KERNEL_MEMORY_LIMIT,
+                 interval=config.KERNEL_WATCHDOG_INTERVAL):
+        threading.Thread.__init__(self, daemon=True)
+        self.process = process
+        self.pid = process.pid
+        self.kernel_ident = ident
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.memory_limit = memory_limit
+        self.interval = interval
+        self.interrupted = None  # execution_id of the last interrupted cell
+        self.oom_kills = resource_limits.oom_kills(ident) or 0
+
+    def run(self):
+        logger.info("Running memory watchdog...")
+        while True:
+            sleep(self.interval)
+            execution = running_execution()
+            execution_id = execution["execution_id"] if execution is not None else None
+
+            # A dead kernel has no resident memory, it mustn't pass for a healthy one
+            oom_kills = resource_limits.oom_kills(self.kernel_ident) or 0
+            if self.process.poll() is not None or oom_kills > self.oom_kills:
+                self.died(oom_kills > self.oom_kills, execution_id)
+                return
+
+            rss = metrics.process_rss(self.pid)
+            if self.hard_limit and rss >= self.hard_limit:
+                self.restart(rss, execution_id)
+                return
+
+            if self.soft_limit and rss >= self.soft_limit and execution is not None and execution_id != self.interrupted:
+                self.interrupt(rss, execution_id)
+
+    def interrupt(self, rss, execution_id):
+        logger.warning("Kernel uses %s, interrupting execution %s" % (format_bytes(rss), execution_id))
+        self.interrupted = execution_id
+        interrupt_kernel()
+        send_message(
+            "The kernel uses %s of memory, more than the limit of %s, so the running cell was interrupted. "
+            "Free memory with `del` or work on smaller parts of the data." % (format_bytes(rss), format_bytes(self.soft_limit)),
+            execution_id=execution_id,
+        )
+        send_message("memory_limit", "status", action="interrupt", rss=rss, execution_id=execution_id)
+
+    def restart(self, rss, execution_id):
+        logger.warning("Kernel uses %s, restarting it" % format_bytes(rss))
+        # Killed right away, so memory is freed before the kernel program gets to the restart
+        self.kill()
+        self.report_restart(
+            "The kernel uses %s of memory, more than the limit of %s, so it was restarted."
+            % (format_bytes(rss), format_bytes(self.hard_limit)),
+            rss, execution_id,
+        )
+
+    def died(self, oom_killed, execution_id):
+        returncode = self.process.poll()
+        if returncode is None:
+            # The OOM killer got one of the kernel's child processes, its state is unknown
+            self.kill()
+        logger.warning("Kernel died with code %s, OOM kill: %s" % (returncode, oom_killed))
+
+        if oom_killed or returncode == -getattr(signal, "SIGKILL", 9):
+            limit = " of %s" % format_bytes(self.memory_limit) if self.memory_limit else ""
+            text = "The kernel was killed after running out of memory%s, so it was restarted." % limit
+        else:
+            text = "The kernel stopped unexpectedly (exit code %s), so it was restarted." % returncode
+        self.report_restart(text, 0, execution_id)
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL if os.name != "nt" else signal.SIGTERM)
+        except OSError:
+            pass
+
+    def report_restart(self, text, rss, execution_id):
+        send_message(text + " Variables and imports are gone and have to be recreated.", execution_id=execution_id)
+        abort_executions()
+        send_message("memory_limit", "status", action="restart", rss=rss, execution_id=execution_id)
+
+
+def format_bytes(n):
+    return "%.1f GB" % (n / 2 ** 30) if n >= 2 ** 30 else "%d MB" % (n // 2 ** 20)
+
+
+def spawned_processes():
+    """Yield the pid, process type and kernel manager ident of every spawned process."""
+    for filename in os.listdir(config.KERNEL_PID_DIR):
+        fp = os.path.join(config.KERNEL_PID_DIR, filename)
+        try:
+            # PID files contain "<process type> <kernel manager ident>"
+            with open(fp) as p:
+                process_type, ident = p.read().split()
+            yield int(filename.split(".pid")[0]), process_type, ident
+        except (OSError, ValueError):
+            continue
+
+
+def connection_file_path(ident):
+    return os.path.join(os.path.abspath(config.KERNEL_CONNECTION_DIR), "kernel_connection_file_%s.json" % ident)
+
+
+def remove_connection_files(ident=None):
+    """Remove the connection file of kernel manager `ident`, or all of them."""
+    if ident is not None:
+        paths = [connection_file_path(ident)]
+    elif os.path.isdir(config.KERNEL_CONNECTION_DIR):
+        paths = [entry.path for entry in os.scandir(config.KERNEL_CONNECTION_DIR)]
+    else:
+        paths = []
+
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def cleanup_spawned_processes(ident=None):
+    """Kill spawned processes, only those belonging to kernel manager `ident` if given."""
+    logger.debug("Cleaning up kernels...")
     for filename in os.listdir(config.KERNEL_PID_DIR):
         fp = os.path.join(config.KERNEL_PID_DIR, filename)
         if os.path.isfile(fp):
             try:
+                with open(fp) as p:
+                    content = p.read().split()
+                if ident is not None and content[-1:] != [ident]:
+                    continue
+
                 pid = int(filename.split(".pid")[0])
                 logger.debug("Killing process with pid %s" % pid)
                 os.remove(fp)
@@ -56,7 +259,8 @@ def cleanup_spawned_processes():
                         os.kill(pid, signal.CTRL_BREAK_EVENT)
                     else:
                         os.kill(pid, signal.SIGKILL)
-                    
+                    metrics.processes_killed.labels(content[0] if content else "unknown").inc()
+
                     # After successful kill, cleanup pid file
                     os.remove(fp)
 
@@ -66,114 +270,403 @@ def cleanup_spawned_processes():
             except Exception as e:
                 logger.debug(e)
 
+    # Only this kernel manager's cgroup, others may be starting with an empty one
+    if ident is not None:
+        resource_limits.remove_cgroup(ident)
+    else:
+        resource_limits.remove_stale_cgroups()
+    remove_connection_files(ident)
 
-def start_snakemq(kc):
-    global messaging
 
-    messaging, link = utils.init_snakemq(config.IDENT_KERNEL_MANAGER, "connect")
+def start_snakemq(kc, ident=config.IDENT_KERNEL_MANAGER):
+    global messaging, shell_thread
 
-    def on_recv(conn, ident, message):
-        if ident == config.IDENT_MAIN:
-            message = json.loads(message.data.decode("utf-8"))
+    messaging = transport.init_transport(ident, "connect")
 
+    def on_recv(ident, message):
+        if ident == config.IDENT_MAIN:
             if message["type"] == "execute":
                 logger.debug("Executing command: %s" % message["value"])
-                kc.execute(message["value"])
-                # Try direct flush with default wait (0.2)
-                flush_kernel_msgs(kc)
+                execute(message["value"], message.get("execution_id"), message.get("profile"), **(message.get("options") or {}))
+            elif message["type"] == "interrupt":
+                logger.debug("Interrupting kernel")
+                interrupt_kernel()
 
-    messaging.on_message_recv.add(on_recv)
+    messaging.on_message(on_recv)
 
-    start_flusher(kc)
+    shell_thread = ShellThread(kc)
+    shell_thread.start()
+    start_iopub_reader(kc)
+    if config.KERNEL_MEMORY_LIMIT or config.KERNEL_MEMORY_SOFT_LIMIT or config.KERNEL_MEMORY_HARD_LIMIT:
+        MemoryWatchdog(kernel_process, ident).start()
 
     # Send alive
-    utils.send_json(messaging, {"type": "status", "value": "ready"}, config.IDENT_MAIN)
+    startup_times["ready"] = time.time()
+    send_message("ready", "status", startup=startup_times)
     logger.info("Python kernel ready to receive messages!")
 
-    logger.info("Starting snakemq loop")
+    logger.info("Starting %s loop" % config.KERNEL_TRANSPORT)
 
     try:
-        link.loop()
+        messaging.loop()
     except KeyboardInterrupt:
         logger.info("Keyboard interrupt received, exiting...")
         sys.exit(0)
     except Exception as e:
-        logger.error("Error in snakemq loop: %s" % e)
+        logger.error("Error in %s loop: %s" % (config.KERNEL_TRANSPORT, e))
         sys.exit(1)
 
 
-def start_flusher(kc):
-    # Start FlushMessenger
-    kill_sema = threading.Semaphore()
-    kill_sema.acquire()
-    t = FlushingThread(kc, kill_sema)
+def start_iopub_reader(kc):
+    t = IOPubThread(kc)
     t.start()
 
-    def end_thread():
-        kill_sema.release()
 
-    atexit.register(end_thread)
+def check_options(options):
+    """Return why `options` can't be passed to execute(), None if they can."""
+    if options is None:
+        return None
+    if not isinstance(options, dict):
+        return "options must be an object"
+    for key, value in options.items():
+        if key not in EXECUTE_OPTIONS:
+            return "Unknown option %r, allowed are %s" % (key, ", ".join(sorted(EXECUTE_OPTIONS)))
+        if not isinstance(value, EXECUTE_OPTIONS[key]):
+            return "Option %r must be a %s" % (key, EXECUTE_OPTIONS[key].__name__)
+    return None
+
+
+def check_profile(profile):
+    """Return why `profile` can't be passed to execute(), None if it can."""
+    if profile is None or isinstance(profile, bool):
+        return None
+    if not isinstance(profile, dict):
+        return "profile must be a boolean or an object"
+    for key, value in profile.items():
+        if key not in PROFILE_OPTIONS:
+            return "Unknown profile option %r, allowed are %s" % (key, ", ".join(sorted(PROFILE_OPTIONS)))
+        # bool is an int too, but not a valid top
+        if not isinstance(value, PROFILE_OPTIONS[key]) or (key == "top" and (isinstance(value, bool) or value <= 0)):
+            return "Profile option %r must be a %s" % (key, "positive integer" if key == "top" else "boolean")
+    return None
+
+
+def execute(code, execution_id=None, profile=None, **options):
+    """Send `code` to the kernel, tracking it as `execution_id` if given.
+
+    With `profile`, True or a dict of kernel_profiler.arm's options, the
+    cell runs under the profiler and its report is sent as a "profile" result.
+    """
+    content = dict(
+        code=code,
+        silent=False,
+        store_history=True,
+        user_expressions={},
+        allow_stdin=False,
+        stop_on_error=True,
+    )
+    content.update((k, v) for k, v in options.items() if k in EXECUTE_OPTIONS)
+    msg = shell_thread.kc.session.msg("execute_request", content)
+
+    # Registered before sending, so the kernel's first output can't beat it
+    if execution_id is not None:
+        with executions_lock:
+            executions[msg["header"]["msg_id"]] = {
+                "execution_id": execution_id,
+                "received_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "output_bytes": 0,
+                "dropped_bytes": 0,
+                "reply": None,
+            }
+
+    if profile:
+        arm_options = {"msg_id": msg["header"]["msg_id"]}
+        if isinstance(profile, dict):
+            arm_options.update((k, v) for k, v in profile.items() if k in ("cpu", "memory", "top"))
+        # Silent, so it neither shows up in the history nor gets profiled itself
+        shell_thread.send(shell_thread.kc.session.msg("execute_request", dict(
+            code="__import__(%r, fromlist=['arm']).arm(**%r)" % (kernel_profiler.__name__, arm_options),
+            silent=True,
+            store_history=False,
+            user_expressions={},
+            allow_stdin=False,
+            stop_on_error=False,
+        )))
+
+    shell_thread.send(msg)
+    return msg["header"]["msg_id"]
+
+
+def interrupt_kernel():
+    """Interrupt the cell the kernel is running, as Ctrl-C would."""
+    kc = shell_thread.kc
+    with control_lock:
+        kc.control_channel.send(kc.session.msg("interrupt_request", {}))
+        # The replies aren't needed, drop them instead of letting them pile up
+        while kc.control_channel.msg_ready():
+            kc.control_channel.get_msg(timeout=0)
+
+
+def get_execution(msg):
+    with executions_lock:
+        return executions.get(msg["parent_header"].get("msg_id"))
+
+
+def running_execution():
+    """Return the execution the kernel is busy with, None when it's idle."""
+    with executions_lock:
+        for execution in executions.values():
+            if execution["started_at"] is not None and execution["finished_at"] is None:
+                return execution
+    return None
+
+
+def finish_execution(msg_id):
+    """Report an execution as done once the kernel went idle and its reply came in."""
+    with executions_lock:
+        execution = executions.get(msg_id)
+        if execution is None or execution["finished_at"] is None or execution["reply"] is None:
+            return
+        del executions[msg_id]
+
+    send_done(execution, execution["reply"].get("status"))
+
+
+def abort_executions():
+    """Report all unfinished executions as aborted, their kernel is gone."""
+    with executions_lock:
+        aborted = list(executions.values())
+        executions.clear()
+
+    for execution in aborted:
+        if execution["finished_at"] is None:
+            execution["finished_at"] = time.time()
+        send_done(execution, "aborted")
+
+
+def send_done(execution, status):
+    if execution["dropped_bytes"]:
+        send_message(
+            "Output truncated, %d bytes dropped." % execution["dropped_bytes"],
+            execution_id=execution["execution_id"],
+        )
+
+    send_message(
+        "done",
+        "status",
+        execution_id=execution["execution_id"],
+        status=status,
+        received_at=execution["received_at"],
+        started_at=execution["started_at"],
+        finished_at=execution["finished_at"],
+        output_bytes=execution["output_bytes"],
+        dropped_bytes=execution["dropped_bytes"],
+    )
 
 
-def send_message(message, message_type="message"):
-    utils.send_json(
-        messaging, {"type": message_type, "value": message}, config.IDENT_MAIN
-    )
+def handle_shell_msg(msg):
+    if msg["msg_type"] == "execute_reply":
+        msg_id = msg["parent_header"].get("msg_id")
+        with executions_lock:
+            execution = executions.get(msg_id)
+            if execution is not None:
+                execution["reply"] = msg["content"]
+        finish_execution(msg_id)
+
+
+def send_message(message, message_type="message", **extra):
+    messaging.send(config.IDENT_MAIN, dict(extra, type=message_type, value=message))
+
 
+def flush_kernel_msgs(kc, timeout=None, coalesce_window=0):
+    """Wait for the next iopub message and forward it to the main process.
 
-def flush_kernel_msgs(kc, tries=1, timeout=0.2):
+    When the message is stream output, further messages arriving within
+    `coalesce_window` seconds are collected too and adjacent stream chunks
+    are sent as a single message.
+    """
+    msgs = []
     try:
-        hit_empty = 0
+        msgs.append(kc.get_iopub_msg(timeout=timeout))
 
-        while True:
-            try:
-                msg = kc.get_iopub_msg(timeout=timeout)
-                if msg["msg_type"] == "execute_result":
-                    if "text/plain" in msg["content"]["data"]:
-                        send_message(
-                            msg["content"]["data"]["text/plain"], "message_raw"
-                        )
-                if msg["msg_type"] == "display_data":
-                    if "image/png" in msg["content"]["data"]:
-                        # Convert to Slack upload
-                        send_message(
-                            msg["content"]["data"]["image/png"],
-                            message_type="image/png",
-                        )
-                    elif "text/plain" in msg["content"]["data"]:
-                        send_message(msg["content"]["data"]["text/plain"])
-
-                elif msg["msg_type"] == "stream":
-                    logger.debug("Received stream output %s" % msg["content"]["text"])
-                    send_message(msg["content"]["text"])
-                elif msg["msg_type"] == "error":
-                    send_message(
-                        utils.escape_ansi("\n".join(msg["content"]["traceback"])),
-                        "message_raw",
-                    )
-            except queue.Empty:
-                hit_empty += 1
-                if hit_empty == tries:
-                    # Empty queue for one second, give back control
+        if coalesce_window > 0 and msgs[0]["msg_type"] == "stream":
+            deadline = time.monotonic() + coalesce_window
+            while msgs[-1]["msg_type"] == "stream":
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
                     break
-            except (ValueError, IndexError):
-                # get_iopub_msg suffers from message fetch errors
-                break
-            except Exception as e:
-                logger.debug(f"{e} [{type(e)}")
-                logger.debug(traceback.format_exc())
-                break
+                msgs.append(kc.get_iopub_msg(timeout=remaining))
+    except queue.Empty:
+        pass
+    except (ValueError, IndexError):
+        # get_iopub_msg suffers from message fetch errors
+        pass
     except Exception as e:
         logger.debug(f"{e} [{type(e)}")
+        logger.debug(traceback.format_exc())
+
+    for msg in coalesce_stream_msgs(msgs):
+        try:
+            handle_kernel_msg(msg)
+        except Exception as e:
+            logger.debug(f"{e} [{type(e)}")
+
+
+def coalesce_stream_msgs(msgs):
+    """Merge adjacent stream messages of the same stream and execution."""
+    merged = []
+    for msg in msgs:
+        if merged and msg["msg_type"] == "stream" and merged[-1]["msg_type"] == "stream":
+            prev = merged[-1]
+            if (prev["content"]["name"] == msg["content"]["name"]
+                    and prev["parent_header"].get("msg_id") == msg["parent_header"].get("msg_id")):
+                prev["content"]["text"] += msg["content"]["text"]
+                continue
+        merged.append(dict(msg, content=dict(msg["content"])))
+    return merged
+
+
+def limit_cell_output(execution, text):
+    """Return the part of `text` that still fits into its cell's output limit."""
+    if execution is None:
+        return text
+
+    data = text.encode("utf-8")
+    if config.CELL_OUTPUT_MAX_BYTES > 0:
+        allowed = max(0, config.CELL_OUTPUT_MAX_BYTES - execution["output_bytes"])
+        if len(data) > allowed:
+            execution["dropped_bytes"] += len(data) - allowed
+            data = data[:allowed]
+            text = data.decode("utf-8", errors="ignore")
+
+    execution["output_bytes"] += len(data)
+    return text
+
+
+def published_at(msg):
+    date = msg["header"].get("date")
+    return date.timestamp() if hasattr(date, "timestamp") else time.time()
+
+
+def handle_kernel_msg(msg):
+    execution = get_execution(msg)
+    # Every output is tagged with the execution it belongs to, and when the kernel published it
+    tags = {"execution_id": execution["execution_id"]} if execution is not None else {}
+    tags["iopub_at"] = published_at(msg)
+
+    if msg["msg_type"] == "status":
+        if execution is not None:
+            if msg["content"]["execution_state"] == "busy" and execution["started_at"] is None:
+                execution["started_at"] = time.time()
+                send_message("running", "status", started_at=execution["started_at"], **tags)
+            elif msg["content"]["execution_state"] == "idle":
+                execution["finished_at"] = time.time()
+                finish_execution(msg["parent_header"]["msg_id"])
+
+    elif msg["msg_type"] == "execute_result":
+        if "text/plain" in msg["content"]["data"]:
+            text = limit_cell_output(execution, msg["content"]["data"]["text/plain"])
+            if text:
+                send_message(text, "message_raw", **tags)
+    if msg["msg_type"] == "display_data":
+        image_types = [t for t in blob_store.BLOB_EXTENSIONS if t in msg["content"]["data"]]
+        if kernel_profiler.MIMETYPE in msg["content"]["data"]:
+            send_message(msg["content"]["data"][kernel_profiler.MIMETYPE], "profile", **tags)
+        elif image_types:
+            # Images go to the blob store once, only their name travels through the queues
+            data = base64.b64decode(msg["content"]["data"][image_types[0]])
+            if execution is not None:
+                execution["output_bytes"] += len(data)
+            name = blob_store.store_blob(data, image_types[0])
+            send_message(name, message_type=image_types[0], blob=True, **tags)
+        elif "text/plain" in msg["content"]["data"]:
+            text = limit_cell_output(execution, msg["content"]["data"]["text/plain"])
+            if text:
+                send_message(text, **tags)
+
+    elif msg["msg_type"] == "stream":
+        logger.debug("Received stream output %s" % msg["content"]["text"])
+        text = limit_cell_output(execution, msg["content"]["text"])
+        if text:
+            send_message(text, stream=msg["content"]["name"], **tags)
+    elif msg["msg_type"] == "error":
+        send_message(
+            utils.escape_ansi("\n".join(msg["content"]["traceback"])),
+            "message_raw",
+            **tags
+        )
+
+
+def write_connection_file(path, ip="127.0.0.1"):
+    """Write a connection file with free ports, for the kernel to use instead of writing its own.
+
+    The kernel's address is known before it starts, so there's no waiting
+    for it to appear.
+    """
+    sockets = [socket.socket() for _ in range(5)]
+    try:
+        for s in sockets:
+            s.bind((ip, 0))
+        ports = [s.getsockname()[1] for s in sockets]
+    finally:
+        for s in sockets:
+            s.close()
+
+    info = dict(zip(["shell_port", "iopub_port", "stdin_port", "control_port", "hb_port"], ports))
+    info.update(
+        ip=ip,
+        transport="tcp",
+        key=str(uuid.uuid4()),
+        signature_scheme="hmac-sha256",
+        kernel_name="",
+    )
+    with open(path, "w") as f:
+        json.dump(info, f)
+
+
+def wait_for_kernel(kc, process, timeout=60):
+    """Return once the kernel answers a kernel_info request, raise RuntimeError if it exits or `timeout` runs out.
+
+    The ports in the connection file are only bound once the kernel got that
+    far, before that the heartbeat looks like a dead kernel to wait_for_ready.
+    """
+    deadline = time.monotonic() + timeout
+
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError("Kernel exited with code %s while starting" % process.returncode)
+        try:
+            for port in (kc.shell_port, kc.hb_port):
+                socket.create_connection((kc.ip, port), timeout=1).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError("Kernel didn't start listening in %d seconds" % timeout)
+            sleep(0.05)
+
+    kc.start_channels()
+    while True:
+        try:
+            kc.wait_for_ready(timeout=max(1, deadline - time.monotonic()))
+            return
+        except RuntimeError:
+            # A heartbeat missed while the kernel is busy importing, unless it's really gone
+            if process.poll() is not None or time.monotonic() > deadline:
+                raise
+            logger.debug("Kernel not ready yet, retrying")
 
 
-def start_kernel():
-    kernel_connection_file = os.path.join(os.getcwd(), "kernel_connection_file.json")
+def start_kernel(ident=config.IDENT_KERNEL_MANAGER):
+    global kernel_process
+
+    kernel_connection_file = connection_file_path(ident)
+    os.makedirs(config.KERNEL_CONNECTION_DIR, mode=0o700, exist_ok=True)
 
-    if os.path.isfile(kernel_connection_file):
-        os.remove(kernel_connection_file)
     if os.path.isdir(kernel_connection_file):
         os.rmdir(kernel_connection_file)
+    write_connection_file(kernel_connection_file)
 
     launch_kernel_script_path = os.path.join(
         pathlib.Path(__file__).parent.resolve(), "launch_kernel.py"
@@ -190,35 +683,63 @@ def start_kernel():
             "--matplotlib=inline",
             "--quiet",
         ],
-        cwd='workspace/'
+        cwd='workspace/',
+        # Memory and CPU limits, applied in the child before the kernel starts
+        preexec_fn=resource_limits.kernel_preexec_fn(ident) if os.name != "nt" else None,
     )
     # Write PID for caller to kill
     str_kernel_pid = str(kernel_process.pid)
     os.makedirs(config.KERNEL_PID_DIR, exist_ok=True)
     with open(os.path.join(config.KERNEL_PID_DIR, str_kernel_pid + ".pid"), "w") as p:
-        p.write("kernel")
+        p.write("kernel %s" % ident)
+    startup_times["kernel launched"] = time.time()
 
-    # Wait for kernel connection file to be written
-    while True:
-        if not os.path.isfile(kernel_connection_file):
-            sleep(0.1)
-        else:
-            # Keep looping if JSON parsing fails, file may be partially written
-            try:
-                with open(kernel_connection_file, 'r') as fp:
-                    json.load(fp)
-                break
-            except json.JSONDecodeError:
-                pass
+    # Imported while the kernel boots
+    from jupyter_client import BlockingKernelClient
 
-    # Client
     kc = BlockingKernelClient(connection_file=kernel_connection_file)
     kc.load_connection_file()
-    kc.start_channels()
-    kc.wait_for_ready()
+    wait_for_kernel(kc, kernel_process)
+    startup_times["kernel connected"] = time.time()
     return kc
 
 
+def preload_kernel(kc, modules=config.KERNEL_PRELOAD_MODULES, timeout=120):
+    """Import `modules` in the kernel so the first cell doesn't pay for it.
+
+    Modules are only loaded into sys.modules, the user namespace stays empty.
+    """
+    if not modules:
+        return
+
+    code = "\n".join(
+        "try:\n    __import__(%r)\nexcept ImportError:\n    pass" % module
+        for module in modules
+    )
+    msg_id = kc.execute(code, silent=True, store_history=False)
+
+    # Drain iopub until the kernel is done, so none of this shows up as output
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            msg = kc.get_iopub_msg(timeout=deadline - time.monotonic())
+        except queue.Empty:
+            break
+        if (msg["parent_header"].get("msg_id") == msg_id
+                and msg["msg_type"] == "status"
+                and msg["content"]["execution_state"] == "idle"):
+            break
+
+    logger.debug("Preloaded modules %s" % ", ".join(modules))
+    startup_times["modules preloaded"] = time.time()
+
+
 if __name__ == "__main__":
-    kc = start_kernel()
-    start_snakemq(kc)
\ No newline at end of file
+    startup_times["manager imported"] = time.time()
+    ident = sys.argv[1] if len(sys.argv) > 1 else config.IDENT_KERNEL_MANAGER
+    try:
+        kc = start_kernel(ident)
+        preload_kernel(kc)
+        start_snakemq(kc, ident)
+    finally:
+        remove_connection_files(ident)
\ No newline at end of file
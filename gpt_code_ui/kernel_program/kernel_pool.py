@@ -0,0 +1,288 @@
+import os
+import sys
+import pathlib
+import subprocess
+import threading
+import itertools
+import time
+
+from collections import deque
+
+import gpt_code_ui.kernel_program.kernel_manager as kernel_manager
+import gpt_code_ui.kernel_program.config as config
+import gpt_code_ui.kernel_program.resource_limits as resource_limits
+import gpt_code_ui.metrics as metrics
+
+from gpt_code_ui.kernel_program.result_queue import ResultQueue
+
+logger = config.get_logger()
+
+READY_MESSAGE = {"value": "Kernel is ready.", "type": "message"}
+
+DIED_MESSAGE = ("The kernel stopped unexpectedly (exit code %s), so it was restarted. "
+                "Variables and imports are gone and have to be recreated.")
+
+
+class KernelPool:
+    """Gives every session its own kernel and keeps spare kernels warm.
+
+    Each kernel is run by a separate kernel_manager process that connects to
+    snakemq under its own identity, so results can be routed back to the
+    session that owns the kernel.
+    """
+
+    def __init__(self, spares=config.KERNEL_POOL_SPARES, session_timeout=config.KERNEL_SESSION_TIMEOUT,
+                 check_interval=config.KERNEL_CHECK_INTERVAL, on_release=None):
+        self.spares_target = spares
+        self.session_timeout = session_timeout
+        self.check_interval = check_interval
+        # Called with the session after its kernel was shut down
+        self.on_release = on_release
+
+        self.lock = threading.RLock()
+        self.counter = itertools.count()
+
+        self.processes = {}  # ident -> kernel_manager process
+        self.ready = set()  # idents that reported ready
+        self.spares = deque()  # unassigned idents, oldest first
+        self.kernels = {}  # session -> ident
+        self.sessions = {}  # ident -> session
+        self.results = {}  # session -> result queue
+        self.last_seen = {}  # session -> time.monotonic() of the last request
+
+        self.restarting = {}  # session -> time.monotonic() the restart was requested
+        self.restart_times = deque(maxlen=100)  # seconds from restart to a ready kernel
+
+    def start(self):
+        # Left behind by an earlier run, before any kernel starts in one
+        resource_limits.remove_stale_cgroups()
+        self.top_up()
+
+        if self.session_timeout > 0:
+            threading.Thread(target=self.reap_idle_sessions, daemon=True).start()
+        threading.Thread(target=self.reap_dead_processes, daemon=True).start()
+
+    def start_kernel_manager(self):
+        ident = "%s-%d" % (config.IDENT_KERNEL_MANAGER, next(self.counter))
+
+        kernel_manager_script_path = os.path.join(
+            pathlib.Path(__file__).parent.resolve(), "kernel_manager.py"
+        )
+        process = subprocess.Popen(
+            [sys.executable, kernel_manager_script_path, ident]
+        )
+
+        # Write PID as <pid>.pid to config.KERNEL_PID_DIR
+        os.makedirs(config.KERNEL_PID_DIR, exist_ok=True)
+        with open(os.path.join(config.KERNEL_PID_DIR, "%d.pid" % process.pid), "w") as p:
+            p.write("kernel_manager %s" % ident)
+
+        self.processes[ident] = process
+        logger.debug("Started kernel manager %s" % ident)
+        return ident
+
+    def top_up(self):
+        with self.lock:
+            while len(self.spares) < self.spares_target:
+                self.spares.append(self.start_kernel_manager())
+
+    def take_spare(self):
+        # Prefer a kernel that is already warm, then the one closest to being ready
+        for ident in self.spares:
+            if ident in self.ready:
+                self.spares.remove(ident)
+                return ident
+        if self.spares:
+            return self.spares.popleft()
+        return self.start_kernel_manager()
+
+    def acquire(self, session):
+        """Return the ident of the session's kernel, assigning one on first use."""
+        self.check(session)
+
+        with self.lock:
+            self.last_seen[session] = time.monotonic()
+
+            ident = self.kernels.get(session)
+            if ident is None:
+                ident = self.take_spare()
+                self.kernels[session] = ident
+                self.sessions[ident] = session
+                if ident in self.ready:
+                    self.record_restart(session)
+                    self.result_queue(session).put(READY_MESSAGE)
+                self.top_up()
+
+            return ident
+
+    def touch(self, session):
+        with self.lock:
+            self.last_seen[session] = time.monotonic()
+
+    def result_queue(self, session):
+        with self.lock:
+            return self.results.setdefault(session, ResultQueue())
+
+    def result_queue_of(self, ident):
+        """Return the result queue of the session owning `ident`, None for spares."""
+        with self.lock:
+            session = self.sessions.get(ident)
+            if session is None:
+                return None
+            return self.result_queue(session)
+
+    def session_of(self, ident):
+        with self.lock:
+            return self.sessions.get(ident)
+
+    def queued_results(self):
+        with self.lock:
+            queues = list(self.results.values())
+        return sum(queue.qsize() for queue in queues)
+
+    def on_ready(self, ident):
+        with self.lock:
+            self.ready.add(ident)
+            queue = self.result_queue_of(ident)
+            if queue is not None:
+                self.record_restart(self.sessions[ident])
+
+        if queue is not None:
+            queue.put(READY_MESSAGE)
+
+    def detach(self, session):
+        """Take the session's kernel out of the pool, return its ident and process, None if it has none."""
+        with self.lock:
+            ident = self.kernels.pop(session, None)
+            if ident is None:
+                return None
+            del self.sessions[ident]
+            self.ready.discard(ident)
+            return ident, self.processes.pop(ident)
+
+    def shut_down(self, session, ident, process):
+        kernel_manager.cleanup_spawned_processes(ident)
+        process.wait()
+        if self.on_release is not None:
+            self.on_release(session)
+
+    def release(self, session, forget=False):
+        """Shut down the kernel of a session, and drop its results if `forget`."""
+        detached = self.detach(session)
+        if detached is not None:
+            self.shut_down(session, *detached)
+
+        if forget:
+            # Only now, on_release may still have queued results for the session
+            with self.lock:
+                self.results.pop(session, None)
+                self.last_seen.pop(session, None)
+
+    def restart(self, session):
+        # Swaps in a warm spare when there is one, so the session is ready right away
+        with self.lock:
+            self.restarting[session] = time.monotonic()
+        metrics.kernel_restarts.inc()
+        self.release(session)
+        return self.acquire(session)
+
+    def check(self, session=None):
+        """Replace kernel managers that exited, only the session's if given.
+
+        Sessions that lost their kernel are told so and get a new one, their
+        queued cells are aborted by on_release. Returns those sessions.
+        """
+        died = []
+        with self.lock:
+            if session is None:
+                idents = list(self.processes)
+            else:
+                idents = [self.kernels[session]] if session in self.kernels else []
+
+            for ident in idents:
+                process = self.processes[ident]
+                if process.poll() is None:
+                    continue
+
+                logger.warning("Kernel manager %s exited with code %s" % (ident, process.returncode))
+                owner = self.sessions.get(ident)
+                if owner is None:
+                    self.spares.remove(ident)
+                    self.ready.discard(ident)
+                    del self.processes[ident]
+                    died.append((None, ident, process))
+                else:
+                    self.restarting[owner] = time.monotonic()
+                    died.append((owner,) + self.detach(owner))
+
+        for owner, ident, process in died:
+            if owner is None:
+                # Its kernel may have outlived it
+                kernel_manager.cleanup_spawned_processes(ident)
+                continue
+
+            metrics.kernel_restarts.inc()
+            self.result_queue(owner).put({"type": "message", "value": DIED_MESSAGE % process.returncode})
+            self.shut_down(owner, ident, process)
+            self.acquire(owner)
+
+        if died:
+            self.top_up()
+        return [owner for owner, _, _ in died if owner is not None]
+
+    def reap_dead_processes(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Error checking kernel managers")
+
+    def replace_spare(self, ident):
+        """Shut down a spare whose kernel is gone and start another one."""
+        with self.lock:
+            if ident not in self.spares:
+                return
+            self.spares.remove(ident)
+            self.ready.discard(ident)
+            process = self.processes.pop(ident)
+
+        kernel_manager.cleanup_spawned_processes(ident)
+        process.wait()
+        self.top_up()
+
+    def record_restart(self, session):
+        started = self.restarting.pop(session, None)
+        if started is not None:
+            duration = time.monotonic() - started
+            self.restart_times.append(duration)
+            logger.info("Kernel restart took %.2fs" % duration)
+
+    def reap_idle_sessions(self):
+        while True:
+            time.sleep(min(60, self.session_timeout))
+
+            now = time.monotonic()
+            with self.lock:
+                idle = [
+                    session for session, seen in self.last_seen.items()
+                    if now - seen > self.session_timeout
+                ]
+
+            for session in idle:
+                logger.info("Shutting down kernel of idle session %s" % session)
+                self.release(session, forget=True)
+
+    def status(self):
+        with self.lock:
+            return {
+                "sessions": len(self.kernels),
+                "spares": len(self.spares),
+                "ready_spares": len([i for i in self.spares if i in self.ready]),
+                "kernels": len(self.processes),
+                "restart_to_ready": {
+                    "count": len(self.restart_times),
+                    "last": self.restart_times[-1] if self.restart_times else None,
+                    "mean": sum(self.restart_times) / len(self.restart_times) if self.restart_times else None,
+                },
+            }
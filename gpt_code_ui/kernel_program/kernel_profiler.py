@@ -0,0 +1,121 @@
+# Runs inside the kernel: profiles the next cell and publishes the result as display data
+import os
+import time
+import pstats
+import cProfile
+import tracemalloc
+
+MIMETYPE = "application/vnd.gpt-code-ui.profile+json"
+
+# Frames of the kernel's own machinery, left out of the hot functions
+IGNORED_PATHS = tuple(
+    os.sep + name + os.sep
+    for name in ("IPython", "ipykernel", "jupyter_client", "traitlets", "tornado", "zmq", "asyncio", "gpt_code_ui")
+)
+
+# cProfile's filename for builtins, like the exec and compile that run the cell
+BUILTIN_FILENAME = "~"
+
+# Prefix of the frozen modules' filenames, e.g. the import machinery's <frozen importlib._bootstrap>
+FROZEN_PREFIX = "<frozen "
+
+
+class CellProfiler:
+    """Profiles a single cell between IPython's pre_run_cell and post_run_cell events.
+
+    Silent cells don't trigger these events, so the silent execute that
+    arms the profiler isn't profiled itself. post_run_cell fires when the
+    cell fails too, so the profile is always published.
+    """
+
+    def __init__(self, shell, msg_id, cpu=True, memory=True, top=20):
+        self.shell = shell
+        self.msg_id = msg_id
+        self.cpu = cpu
+        self.memory = memory
+        self.top = top
+
+        self.profile = None
+        self.started_tracing = False
+
+    def pre_run_cell(self, info):
+        self.shell.events.unregister("pre_run_cell", self.pre_run_cell)
+
+        # When the cell was aborted, the next one must not be profiled in its place
+        if self.shell.parent_header.get("header", {}).get("msg_id") != self.msg_id:
+            self.shell.events.unregister("post_run_cell", self.post_run_cell)
+            return
+
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            tracemalloc.reset_peak()
+            self.memory_before = tracemalloc.get_traced_memory()[0]
+
+        if self.cpu:
+            self.profile = cProfile.Profile()
+
+        self.wall_started = time.perf_counter()
+        self.cpu_started = time.process_time()
+        if self.profile is not None:
+            self.profile.enable()
+
+    def post_run_cell(self, result):
+        if self.profile is not None:
+            self.profile.disable()
+        wall_time = time.perf_counter() - self.wall_started
+        cpu_time = time.process_time() - self.cpu_started
+
+        self.shell.events.unregister("post_run_cell", self.post_run_cell)
+
+        report = {
+            "wall_time": wall_time,
+            "cpu_time": cpu_time,
+            "peak_memory": None,
+            "functions": [],
+        }
+
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # Relative to what was allocated before the cell started
+            report["peak_memory"] = max(0, peak - self.memory_before)
+            if self.started_tracing:
+                tracemalloc.stop()
+
+        if self.profile is not None:
+            report["functions"] = hot_functions(self.profile, self.top)
+
+        from IPython.display import publish_display_data
+        publish_display_data({MIMETYPE: report})
+
+
+def hot_functions(profile, top):
+    """Return the `top` functions by cumulative time, without the kernel's own frames."""
+    stats = pstats.Stats(profile).stats
+    functions = []
+    for (filename, line, name), (primitive_calls, calls, total_time, cumulative_time, _) in stats.items():
+        if (filename == BUILTIN_FILENAME or filename.startswith(FROZEN_PREFIX)
+                or any(ignored in filename for ignored in IGNORED_PATHS)):
+            continue
+        functions.append({
+            "function": name,
+            "file": filename,
+            "line": line,
+            "calls": calls,
+            "total_time": total_time,
+            "cumulative_time": cumulative_time,
+        })
+
+    functions.sort(key=lambda f: f["cumulative_time"], reverse=True)
+    return functions[:top]
+
+
+def arm(msg_id, cpu=True, memory=True, top=20):
+    """Profile the cell of execute request `msg_id`, which must be the next one that isn't silent."""
+    from IPython import get_ipython
+
+    shell = get_ipython()
+    profiler = CellProfiler(shell, msg_id, cpu, memory, top)
+    shell.events.register("pre_run_cell", profiler.pre_run_cell)
+    shell.events.register("post_run_cell", profiler.post_run_cell)
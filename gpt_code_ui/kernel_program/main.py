@@ -1,42 +1,50 @@
 import os
-import subprocess
 import sys
-import pathlib
 import json
 import logging
-import time
 
 import asyncio
 import json
+import time
 import threading
 
-from queue import Queue
+from queue import Queue, Empty
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS  # Import the CORS library
+from werkzeug.serving import make_server
 
 from dotenv import load_dotenv
 load_dotenv('.env')
 
 import gpt_code_ui.kernel_program.kernel_manager as kernel_manager
 import gpt_code_ui.kernel_program.config as config
-import gpt_code_ui.kernel_program.utils as utils
+import gpt_code_ui.kernel_program.transport as transport
+import gpt_code_ui.kernel_program.checkpoints as checkpoints
+import gpt_code_ui.metrics as metrics
+import gpt_code_ui.startup as startup
 
+from gpt_code_ui.kernel_program.kernel_pool import KernelPool
+from gpt_code_ui.kernel_program.executions import ExecutionLog
+from gpt_code_ui.kernel_program.execution_queue import ExecutionQueue
 
-APP_PORT = int(os.environ.get("API_PORT", 5010))
+
+APP_PORT = config.API_PORT
 
 # Get global logger
 logger = config.get_logger()
 
-# Note, only one kernel_manager_process can be active
-kernel_manager_process = None
-
-# Use efficient Python queues to store messages
-result_queue = Queue()
+# Every session gets its own kernel, results are queued per session
+kernel_pool = KernelPool(on_release=lambda session: on_release(session))
+# (ident, message) pairs for the kernel managers
 send_queue = Queue()
+execution_log = ExecutionLog()
 
 messaging = None
 
+# The launcher's queue for startup phases, dropped once the first kernel is ready
+startup_events = None
+
 # We know this Flask app is for local use. So we can disable the verbose Werkzeug logger
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
@@ -47,61 +55,165 @@ cli.show_server_banner = lambda *x: None
 app = Flask(__name__)
 CORS(app)
 
-def start_kernel_manager():
-    global kernel_manager_process
+def dispatch(session, cell):
+    if kernel_pool.check(session):
+        # The session's kernel manager died, the cell was aborted with the others
+        return
+    send_queue.put((
+        kernel_pool.acquire(session),
+        {
+            "type": "execute",
+            "value": cell["command"],
+            "execution_id": cell["execution_id"],
+            "profile": cell.get("profile"),
+            "options": cell.get("options"),
+        },
+    ))
+
+
+# Cells wait here until their session's kernel is free
+execution_queue = ExecutionQueue(
+    dispatch, on_failed=lambda session, execution_id: abort_executions(session, [execution_id], "error")
+)
+
+
+def submit(session, cell, quiet=False):
+    """Queue a cell for the session's kernel, return its execution_id and queue position."""
+    execution_id = execution_log.submit(session, quiet)
+    position = execution_queue.submit(session, dict(cell, execution_id=execution_id))
+    return execution_id, position
+
+
+def checkpoint_idle_session(session):
+    if execution_queue.busy(session):
+        return False
+    submit(session, {
+        "command": checkpoints.save_code(session, checkpoints.DEFAULT_NAME, quiet=True),
+        "options": {"store_history": False},
+    }, quiet=True)
+    return True
+
+
+idle_checkpoints = checkpoints.IdleCheckpoints(checkpoint_idle_session)
 
-    kernel_manager_script_path = os.path.join(
-        pathlib.Path(__file__).parent.resolve(), "kernel_manager.py"
-    )
-    kernel_manager_process = subprocess.Popen(
-        [sys.executable, kernel_manager_script_path]
-    )
 
-    # Write PID as <pid>.pid to config.KERNEL_PID_DIR
-    os.makedirs(config.KERNEL_PID_DIR, exist_ok=True)
-    with open(os.path.join(config.KERNEL_PID_DIR, "%d.pid" % kernel_manager_process.pid), "w") as p:
-        p.write("kernel_manager")
+def on_release(session):
+    # The namespace is gone, an idle checkpoint would overwrite the last good one
+    idle_checkpoints.forget(session)
+    abort_executions(session, execution_queue.clear(session))
+
+
+def abort_executions(session, execution_ids, status="aborted"):
+    """Report executions that won't run, or won't finish, as done."""
+    result_queue = kernel_pool.result_queue(session)
+    for execution_id in execution_ids:
+        execution_log.on_cancel(execution_id, status)
+        result_queue.put({"type": "status", "value": "done", "execution_id": execution_id, "status": status})
+
 
 def cleanup_kernel_program():
     kernel_manager.cleanup_spawned_processes()
 
+
+def register_gauges():
+    # Only once the kernel program runs, the webapp imports this module too
+    metrics.result_queue_depth.set_function(kernel_pool.queued_results)
+    metrics.send_queue_depth.set_function(send_queue.qsize)
+    metrics.execution_queue_depth.set_function(execution_queue.queued)
+    metrics.kernel_count.set_function(lambda: kernel_pool.status()["kernels"])
+    metrics.kernel_rss_bytes.set_function(lambda: sum(
+        metrics.process_rss(pid) for pid, process_type, _ in kernel_manager.spawned_processes()
+        if process_type == "kernel"
+    ))
+
+
+def get_session():
+    return request.args.get("session", config.DEFAULT_SESSION)
+
+
 async def start_snakemq():
     global messaging
 
-    messaging, link = utils.init_snakemq(config.IDENT_MAIN)
+    messaging = transport.init_transport(config.IDENT_MAIN)
 
-    def on_recv(conn, ident, message):
-        message = json.loads(message.data.decode("utf-8"))
+    def on_recv(ident, message):
+        global startup_events
 
         if message["type"] == "status":
             if message["value"] == "ready":
-                logger.debug("Kernel is ready.")
-                result_queue.put({
-                    "value":"Kernel is ready.",
-                    "type": "message"
-                })
-
-        elif message["type"] in ["message", "message_raw", "image/png", "image/jpeg"]:
-            # TODO: 1:1 kernel <> channel mapping
+                logger.debug("Kernel %s is ready." % ident)
+                kernel_pool.on_ready(ident)
+
+                if startup_events is not None:
+                    for phase, at in message.get("startup", {}).items():
+                        startup.report(startup_events, "kernel", phase, at)
+                    startup.report(startup_events, "kernel program", "kernel ready")
+                    startup_events = None
+
+            elif message["value"] in ["running", "done"]:
+                execution_log.on_status(message)
+                quiet = execution_log.is_quiet(message["execution_id"])
+
+                if message["value"] == "done" and message.get("started_at") and message.get("finished_at"):
+                    metrics.kernel_execute_seconds.labels(message["status"] or "unknown").observe(
+                        message["finished_at"] - message["started_at"])
+
+                result_queue = kernel_pool.result_queue_of(ident)
+                if result_queue is not None and not quiet:
+                    result = {"type": "status", "value": message["value"], "execution_id": message["execution_id"]}
+                    if message["value"] == "done":
+                        result["status"] = message["status"]
+                    result_queue.put(result)
+
+                session = kernel_pool.session_of(ident)
+                if message["value"] == "done" and session is not None:
+                    # Hands the next queued cell to the kernel, or aborts the queue after an error
+                    aborted = execution_queue.on_done(session, message["execution_id"], message["status"])
+                    abort_executions(session, aborted)
+                    if not quiet:
+                        idle_checkpoints.on_done(session)
+
+            elif message["value"] == "memory_limit":
+                metrics.kernel_memory_limit_events.labels(message["action"]).inc()
+
+                session = kernel_pool.session_of(ident)
+                if message["action"] == "restart":
+                    # Not on the transport loop, which has to deliver the new kernel's ready message
+                    if session is not None:
+                        threading.Thread(target=kernel_pool.restart, args=(session,), daemon=True).start()
+                    else:
+                        threading.Thread(target=kernel_pool.replace_spare, args=(ident,), daemon=True).start()
+
+        elif message["type"] == "profile":
+            execution_log.on_profile(message)
+
+            result_queue = kernel_pool.result_queue_of(ident)
+            if result_queue is not None:
+                result_queue.put({"type": "profile", "value": message["value"], "execution_id": message.get("execution_id")})
+
+        elif message["type"] in ["message", "message_raw", "image/png", "image/jpeg", "image/gif"]:
             logger.debug("%s of type %s" % (message["value"], message["type"]))
 
-            result_queue.put({
-                "value": message["value"],
-                "type": message["type"]
-            })
+            result_queue = kernel_pool.result_queue_of(ident)
+            if result_queue is None:
+                # Output of a kernel that no longer belongs to a session
+                return
 
-    messaging.on_message_recv.add(on_recv)
-    logger.info("Starting snakemq loop")
+            # Passed on as is, blob references included
+            iopub_at = message.pop("iopub_at", None)
+            result_queue.put(message)
+            execution_log.on_output(message)
+            if iopub_at is not None:
+                metrics.result_delay_seconds.observe(max(0, time.time() - iopub_at))
+
+    messaging.on_message(on_recv)
+    logger.info("Starting %s loop" % config.KERNEL_TRANSPORT)
 
     def send_queued_messages():
         while True:
-            if send_queue.qsize() > 0:
-                message = send_queue.get()
-                utils.send_json(messaging, 
-                    {"type": "execute", "value": message["command"]}, 
-                    config.IDENT_KERNEL_MANAGER
-                )
-            time.sleep(0.1)
+            # Block until a command is queued, the transport wakes up its loop itself
+            ident, message = send_queue.get()
+            messaging.send(ident, message)
 
     async def async_send_queued_messages():
         loop = asyncio.get_event_loop()
@@ -109,37 +221,191 @@ async def start_snakemq():
 
     async def async_link_loop():
         loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, link.loop)
+        await loop.run_in_executor(None, messaging.loop)
 
-    # Wrap the snakemq_link.Link loop in an asyncio task
+    # Wrap the transport loop in an asyncio task
     await asyncio.gather(async_send_queued_messages(), async_link_loop())
 
 
 @app.route("/api", methods=["POST", "GET"])
 def handle_request():
-   
+    session = get_session()
+    kernel_pool.acquire(session)
+
     if request.method == "GET":
         # Handle GET requests by sending everything that's in the receive_queue
-        results = [result_queue.get() for _ in range(result_queue.qsize())]
+        results = kernel_pool.result_queue(session).get_all()
         return jsonify({"results": results})
     elif request.method == "POST":
-        data = request.json
+        if not isinstance(request.json, dict):
+            return jsonify({"error": "The request must be a JSON object"}), 400
+        if not isinstance(request.json.get("command"), str):
+            return jsonify({"error": "The command must be a string"}), 400
+        error = kernel_manager.check_options(request.json.get("options")) or kernel_manager.check_profile(request.json.get("profile"))
+        if error is not None:
+            return jsonify({"error": error}), 400
+
+        execution_id, position = submit(session, request.json)
+
+        # 0 when the cell went to the kernel right away, otherwise the cells ahead of it plus one
+        return jsonify({"result": "success", "execution_id": execution_id, "queue_position": position})
+
+
+@app.route("/executions", methods=["GET"])
+def handle_executions():
+    limit = request.args.get("limit", 20, type=int)
+    return jsonify({"executions": execution_log.list(get_session(), limit)})
+
 
-        send_queue.put(data)
+@app.route("/executions/<execution_id>", methods=["GET"])
+def handle_execution(execution_id):
+    record = execution_log.get(execution_id)
+    if record is None or record["session"] != get_session():
+        return jsonify({"error": "Unknown execution"}), 404
+
+    record["queue_position"] = execution_queue.position(record["session"], execution_id)
+    return jsonify(record)
+
+
+@app.route("/executions/<execution_id>/cancel", methods=["POST"])
+def handle_cancel(execution_id):
+    session = get_session()
+    record = execution_log.get(execution_id)
+    if record is None or record["session"] != session:
+        return jsonify({"error": "Unknown execution"}), 404
+
+    if not execution_queue.cancel(session, execution_id):
+        if execution_queue.position(session, execution_id) == 0:
+            return jsonify({"error": "Execution is already running, use /interrupt to stop it"}), 409
+        return jsonify({"error": "Execution is already done"}), 409
+
+    abort_executions(session, [execution_id], "cancelled")
+    return jsonify({"result": "success"})
+
+
+@app.route("/checkpoint", methods=["POST"])
+def handle_checkpoint():
+    # Runs as a cell, so it waits for the cells queued before it
+    session = get_session()
+    name = request.args.get("name", checkpoints.DEFAULT_NAME)
+    if not checkpoints.valid_name(name):
+        return jsonify({"error": "Invalid checkpoint name"}), 400
+
+    execution_id, position = submit(session, {"command": checkpoints.save_code(session, name), "options": {"store_history": False}})
+    return jsonify({"result": "success", "name": name, "execution_id": execution_id, "queue_position": position})
+
+
+@app.route("/restore", methods=["POST"])
+def handle_restore():
+    session = get_session()
+    name = request.args.get("name", checkpoints.DEFAULT_NAME)
+    if not checkpoints.valid_name(name) or not checkpoints.exists(session, name):
+        return jsonify({"error": "Unknown checkpoint"}), 404
+
+    execution_id, position = submit(session, {"command": checkpoints.restore_code(session, name), "options": {"store_history": False}})
+    return jsonify({"result": "success", "name": name, "execution_id": execution_id, "queue_position": position})
+
+
+@app.route("/checkpoints", methods=["GET"])
+def handle_checkpoints():
+    # Only the session's own, other sessions' checkpoints can't be listed or restored
+    return jsonify({"checkpoints": checkpoints.list_checkpoints(get_session())})
+
+
+@app.route("/interrupt", methods=["POST"])
+def handle_interrupt():
+    # Stops the running cell like Ctrl-C, the kernel and its variables stay.
+    # Queued cells are aborted, as they would be after any other error.
+    send_queue.put((kernel_pool.acquire(get_session()), {"type": "interrupt"}))
+
+    return jsonify({"result": "success"})
+
+
+@app.route("/stream", methods=["GET"])
+def handle_stream():
+    session = get_session()
+    # Assign a kernel right away so the session starts out with a warm one
+    kernel_pool.acquire(session)
+    result_queue = kernel_pool.result_queue(session)
+
+    # The browser sends the id of the last event it got when it reconnects,
+    # a reloaded page passes it along itself
+    try:
+        after = int(request.headers.get("Last-Event-ID") or request.args["after"])
+    except (KeyError, ValueError):
+        after = None
+
+    # Push results to the client as Server-Sent Events as soon as they are queued
+    def generate():
+        # A queue of our own, so a stale stream of the same session can't take our results
+        subscriber = result_queue.subscribe(after)
+        try:
+            while True:
+                try:
+                    result = subscriber.get(timeout=config.STREAM_KEEPALIVE_INTERVAL)
+                except Empty:
+                    # An open stream keeps the session alive
+                    kernel_pool.touch(session)
+                    # SSE comment line, keeps proxies from closing the idle connection
+                    # and lets us notice clients that went away
+                    yield ": keepalive\n\n"
+                    continue
+
+                event_id = result.pop("event_id", None)
+                if event_id is not None:
+                    yield "id: %d\n" % event_id
+                yield "data: %s\n\n" % json.dumps(result)
+        finally:
+            result_queue.unsubscribe(subscriber)
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-        return jsonify({"result": "success"})
     
 @app.route("/restart", methods=["POST"])
 def handle_restart():
 
-    cleanup_kernel_program()
-    start_kernel_manager()
+    kernel_pool.restart(get_session())
 
     return jsonify({"result": "success"})
 
 
-async def main():
-    start_kernel_manager()
+@app.route("/kernels", methods=["GET"])
+def handle_kernels():
+    return jsonify(kernel_pool.status())
+
+
+@app.route("/metrics", methods=["GET"])
+def handle_metrics():
+    return metrics.response()
+
+
+def start_background(events=None):
+    """Run the kernel program without its own web server.
+
+    Used when `app` is mounted into the webapp, so the HTTP hop between the two is skipped.
+    """
+    global startup_events
+
+    startup_events = events
+    kernel_pool.start()
+    startup.report(events, "kernel program", "kernel manager spawned")
+    idle_checkpoints.start()
+    register_gauges()
+    threading.Thread(target=asyncio.run, args=(start_snakemq(),), daemon=True).start()
+
+
+async def main(events=None):
+    global startup_events
+
+    startup_events = events
+    kernel_pool.start()
+    startup.report(events, "kernel program", "kernel manager spawned")
+    idle_checkpoints.start()
+    register_gauges()
 
     # Run Flask app in a separate thread
     flask_thread = threading.Thread(target=run_flask_app)
@@ -150,7 +416,9 @@ async def main():
 
 
 def run_flask_app():
-    app.run(host="0.0.0.0", port=APP_PORT)
+    server = make_server("0.0.0.0", APP_PORT, app, threaded=True)
+    startup.report(startup_events, "kernel program", "listening")
+    server.serve_forever()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,119 @@
+# Memory and CPU limits of kernel processes
+import os
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows
+
+import gpt_code_ui.kernel_program.config as config
+
+logger = config.get_logger()
+
+
+def write_cgroup_file(cgroup, name, value):
+    with open(os.path.join(cgroup, name), "w") as f:
+        f.write(value)
+
+
+def remove_stale_cgroups(root=config.KERNEL_CGROUP_ROOT):
+    """Remove the cgroups of all kernels that are gone, only while no kernel is starting.
+
+    A kernel that is starting has an empty cgroup until it moves itself in.
+    """
+    if not root or not os.path.isdir(root):
+        return
+    # Cgroups of kernels that are gone are empty, removing the others fails
+    for entry in os.scandir(root):
+        if entry.is_dir() and entry.name.startswith(config.IDENT_KERNEL_MANAGER):
+            try:
+                os.rmdir(entry.path)
+            except OSError:
+                pass
+
+
+def remove_cgroup(ident, root=config.KERNEL_CGROUP_ROOT):
+    """Remove the cgroup of kernel manager `ident` once its kernel was killed."""
+    if not root:
+        return
+    cgroup = os.path.join(root, ident)
+    # The killed kernel takes a moment to leave it
+    for _ in range(10):
+        try:
+            os.rmdir(cgroup)
+            return
+        except FileNotFoundError:
+            return
+        except OSError:
+            time.sleep(0.1)
+    logger.debug("Could not remove cgroup %s" % cgroup)
+
+
+def create_cgroup(ident, memory_limit=config.KERNEL_MEMORY_LIMIT, cpu_limit=config.KERNEL_CPU_LIMIT,
+                  root=config.KERNEL_CGROUP_ROOT):
+    """Create a cgroup v2 below `root` with the given limits, None if that isn't possible.
+
+    `root` must be a cgroup the user may create children in, with the memory
+    and cpu controllers enabled for them.
+    """
+    if not root or not (memory_limit or cpu_limit):
+        return None
+
+    cgroup = os.path.join(root, ident)
+    try:
+        os.makedirs(cgroup, exist_ok=True)
+        if memory_limit:
+            write_cgroup_file(cgroup, "memory.max", str(memory_limit))
+            try:
+                # Swapping is what takes the host down, so the kernel is stopped at the limit instead
+                write_cgroup_file(cgroup, "memory.swap.max", "0")
+            except OSError:
+                pass
+        if cpu_limit:
+            period = 100000
+            write_cgroup_file(cgroup, "cpu.max", "%d %d" % (int(cpu_limit * period), period))
+    except OSError as e:
+        logger.warning("Could not set up cgroup %s, falling back to rlimits: %s" % (cgroup, e))
+        return None
+
+    return cgroup
+
+
+def oom_kills(ident, root=config.KERNEL_CGROUP_ROOT):
+    """Return how many processes the OOM killer killed in the kernel's cgroup, None without a cgroup."""
+    if not root:
+        return None
+    try:
+        with open(os.path.join(root, ident, "memory.events")) as f:
+            for line in f:
+                key, value = line.split()
+                if key == "oom_kill":
+                    return int(value)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def kernel_preexec_fn(ident):
+    """Return the function that puts a kernel into its limits before it starts, None without limits."""
+    memory_limit = config.KERNEL_MEMORY_LIMIT
+    cgroup = create_cgroup(ident)
+
+    if cgroup is None and config.KERNEL_CPU_LIMIT:
+        logger.warning("KERNEL_CPU_LIMIT needs a usable KERNEL_CGROUP_ROOT, kernels run without a CPU limit")
+    if cgroup is None and (not memory_limit or resource is None):
+        return None
+
+    def apply_limits():
+        # Runs in the child between fork and exec
+        if cgroup is not None:
+            try:
+                write_cgroup_file(cgroup, "cgroup.procs", str(os.getpid()))
+                return
+            except OSError:
+                pass
+        if memory_limit and resource is not None:
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    return apply_limits
@@ -0,0 +1,151 @@
+import threading
+import itertools
+
+from collections import deque
+from queue import Empty
+
+import gpt_code_ui.kernel_program.config as config
+
+# Results kept for streams that reconnect, at most
+REPLAY_RESULTS = 1000
+
+# Ids of results sent on streams, unique over all queues so an id from
+# another queue or an earlier page can't match the wrong results
+event_ids = itertools.count(1)
+
+
+def truncation_message(dropped_bytes):
+    return {"type": "message", "value": "Output truncated, %d bytes dropped." % dropped_bytes}
+
+
+def result_size(result):
+    return len(result["value"])
+
+
+def can_merge(previous, result):
+    # Only chunks of the same output stream are merged, everything else keeps its own message
+    if previous.get("stream") is None or previous.keys() != result.keys():
+        return False
+    return all(previous[k] == result[k] for k in previous if k not in ("value", "event_id"))
+
+
+class ResultQueue:
+    """Queue of results waiting for a client, bounded by the size of their values.
+
+    Adjacent stream chunks are merged into one result. When the queue grows
+    beyond `max_bytes` the oldest results are dropped and a truncation
+    notice is handed out in their place.
+
+    Streams subscribe to get a queue of their own, every result is put into
+    all of them. A stream whose client went away unnoticed can't take results
+    from the one that replaced it. The latest results are also kept with
+    their event id, so a stream that reconnects gets those it missed.
+    """
+
+    def __init__(self, max_bytes=config.RESULT_QUEUE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.results = deque()
+        self.size = 0
+        self.dropped = 0
+        self.cond = threading.Condition()
+
+        self.subscribers = set()
+        self.recent = deque()  # (event id, result) of the latest results
+        self.recent_size = 0
+        self.last_id = 0
+
+    def put(self, result):
+        with self.cond:
+            self.last_id = next(event_ids)
+            self.remember(self.last_id, result)
+
+            if self.subscribers:
+                for subscriber in self.subscribers:
+                    subscriber.append(dict(result, event_id=self.last_id))
+            else:
+                self.append(result)
+
+    def remember(self, event_id, result):
+        self.recent.append((event_id, dict(result)))
+        self.recent_size += result_size(result)
+        while len(self.recent) > 1 and (len(self.recent) > REPLAY_RESULTS
+                                        or 0 < self.max_bytes < self.recent_size):
+            self.recent_size -= result_size(self.recent.popleft()[1])
+
+    def append(self, result):
+        with self.cond:
+            if self.results and can_merge(self.results[-1], result):
+                self.results[-1]["value"] += result["value"]
+                if "event_id" in result:
+                    self.results[-1]["event_id"] = result["event_id"]
+            else:
+                self.results.append(dict(result))
+            self.size += result_size(result)
+
+            while self.max_bytes > 0 and self.size > self.max_bytes and self.results:
+                excess = self.size - self.max_bytes
+                oldest = self.results[0]
+                if oldest.get("stream") is not None and result_size(oldest) > excess:
+                    # Keep the tail of a long stream instead of dropping it whole
+                    oldest["value"] = oldest["value"][excess:]
+                    dropped = excess
+                else:
+                    dropped = result_size(self.results.popleft())
+                self.size -= dropped
+                self.dropped += dropped
+
+            self.cond.notify()
+
+    def pop(self):
+        if self.dropped:
+            result = truncation_message(self.dropped)
+            self.dropped = 0
+            return result
+
+        result = self.results.popleft()
+        self.size -= result_size(result)
+        return result
+
+    def get(self, timeout=None):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.results or self.dropped, timeout):
+                raise Empty
+            return self.pop()
+
+    def get_all(self):
+        with self.cond:
+            results = []
+            while self.results or self.dropped:
+                results.append(self.pop())
+            return results
+
+    def subscribe(self, after=None):
+        """Return a queue of its own for a stream, it gets every result from now on.
+
+        It starts out with the results after event id `after` as far as they
+        are still kept, otherwise with the results waiting for a client.
+        """
+        subscriber = ResultQueue(self.max_bytes)
+        with self.cond:
+            if after is not None and after <= self.last_id:
+                for event_id, result in self.recent:
+                    if event_id > after:
+                        subscriber.append(dict(result, event_id=event_id))
+            else:
+                for result in self.get_all():
+                    subscriber.append(result)
+
+            # Replayed or handed over, they aren't waiting any more either way
+            self.results.clear()
+            self.size = 0
+            self.dropped = 0
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.cond:
+            self.subscribers.discard(subscriber)
+
+    def qsize(self):
+        with self.cond:
+            return len(self.results) + (1 if self.dropped else 0) + sum(s.qsize() for s in self.subscribers)
@@ -0,0 +1,198 @@
+import json
+import time
+import queue
+import socket
+
+from collections import defaultdict, deque
+
+import gpt_code_ui.kernel_program.config as config
+import gpt_code_ui.kernel_program.utils as utils
+
+logger = config.get_logger()
+
+
+class SnakeMQTransport:
+    """Messaging between the kernel program and its kernel managers over snakemq.
+
+    Messages are dicts, they are sent as JSON and kept for 600 seconds
+    while the receiver isn't connected.
+    """
+
+    def __init__(self, ident, init_type="listen"):
+        self.ident = ident
+        self.messaging, self.link = utils.init_snakemq(ident, init_type)
+
+    def on_message(self, callback):
+        """Call `callback(ident, message)` for every received message, on the loop thread."""
+        def on_recv(conn, ident, message):
+            callback(ident, json.loads(message.data.decode("utf-8")))
+
+        self.messaging.on_message_recv.add(on_recv)
+
+    def send(self, ident, message):
+        # Safe from any thread, snakemq wakes up its link loop itself
+        utils.send_json(self.messaging, message, ident)
+
+    def loop(self):
+        self.link.loop()
+
+    def stop(self):
+        self.link.stop()
+
+
+class ZMQTransport:
+    """Messaging over a ZeroMQ ROUTER/DEALER pair, on a Unix domain socket by default.
+
+    Messages are framed with msgpack, so bytes values are sent as they are
+    instead of being base64 encoded. The listening side holds messages for
+    kernel managers that aren't connected (yet) for up to `ttl` seconds,
+    like snakemq does.
+
+    ZMQ sockets must not be used from several threads, so sends are handed
+    to the loop thread through a queue and a socket pair wakeup.
+    """
+
+    def __init__(self, ident, init_type="listen", address=config.KERNEL_TRANSPORT_ADDRESS, ttl=600):
+        import zmq
+        import msgpack
+
+        self.zmq = zmq
+        self.msgpack = msgpack
+        self.ident = ident
+        self.init_type = init_type
+        self.ttl = ttl
+
+        self.context = zmq.Context.instance()
+        if init_type == "listen":
+            self.socket = self.context.socket(zmq.ROUTER)
+            # Sending to an unknown peer raises instead of silently dropping the message
+            self.socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
+            self.socket.bind(address)
+        elif init_type == "connect":
+            self.socket = self.context.socket(zmq.DEALER)
+            self.socket.setsockopt(zmq.ROUTING_ID, ident.encode("utf-8"))
+            self.socket.connect(address)
+        else:
+            raise Exception("Unsupported init type.")
+        self.socket.setsockopt(zmq.LINGER, 0)
+        # No high water marks, results are bounded per session by the kernel program
+        self.socket.setsockopt(zmq.SNDHWM, 0)
+        self.socket.setsockopt(zmq.RCVHWM, 0)
+
+        self.callbacks = []
+        self.outgoing = queue.Queue()
+        self.pending = defaultdict(deque)  # ident -> (expiry, payload) not deliverable yet
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_send.setblocking(False)
+        self.running = False
+
+    def on_message(self, callback):
+        """Call `callback(ident, message)` for every received message, on the loop thread."""
+        self.callbacks.append(callback)
+
+    def send(self, ident, message):
+        payload = self.msgpack.packb(message, use_bin_type=True)
+        self.outgoing.put((ident, payload))
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.wakeup_send.send(b"\0")
+        except BlockingIOError:
+            pass  # the buffer is full, so a wakeup is pending anyway
+
+    def deliver(self, ident, payload):
+        if self.init_type == "connect":
+            # The only peer is the kernel program
+            self.socket.send(payload, copy=False)
+            return True
+
+        try:
+            self.socket.send_multipart([ident.encode("utf-8"), payload], copy=False)
+            return True
+        except self.zmq.ZMQError as e:
+            if e.errno != self.zmq.EHOSTUNREACH:
+                raise
+            return False
+
+    def flush_outgoing(self):
+        while True:
+            try:
+                ident, payload = self.outgoing.get_nowait()
+            except queue.Empty:
+                return
+            if self.pending.get(ident) or not self.deliver(ident, payload):
+                self.pending[ident].append((time.monotonic() + self.ttl, payload))
+
+    def flush_pending(self, ident):
+        messages = self.pending.pop(ident, None)
+        now = time.monotonic()
+        while messages:
+            expiry, payload = messages[0]
+            if expiry >= now and not self.deliver(ident, payload):
+                self.pending[ident] = messages
+                return
+            messages.popleft()
+
+    def receive(self):
+        while True:
+            try:
+                frames = self.socket.recv_multipart(self.zmq.NOBLOCK, copy=False)
+            except self.zmq.Again:
+                return
+
+            if self.init_type == "listen":
+                ident = bytes(frames[0].buffer).decode("utf-8")
+                # The peer is connected now, so whatever waited for it can go out
+                if ident in self.pending:
+                    self.flush_pending(ident)
+            else:
+                ident = config.IDENT_MAIN
+            message = self.msgpack.unpackb(frames[-1].buffer, raw=False)
+
+            for callback in self.callbacks:
+                try:
+                    callback(ident, message)
+                except Exception as e:
+                    logger.error("Error handling message from %s: %s" % (ident, e))
+
+    def loop(self):
+        poller = self.zmq.Poller()
+        poller.register(self.socket, self.zmq.POLLIN)
+        poller.register(self.wakeup_recv, self.zmq.POLLIN)
+
+        self.running = True
+        while self.running:
+            # Wakes up now and then to expire messages nobody picked up
+            ready = dict(poller.poll(1000 if self.pending else None))
+
+            # Plain sockets are reported by their file descriptor
+            if self.wakeup_recv.fileno() in ready:
+                self.wakeup_recv.recv(4096)
+                self.flush_outgoing()
+
+            if self.socket in ready:
+                self.receive()
+
+            for ident in list(self.pending):
+                self.flush_pending(ident)
+
+        self.socket.close()
+
+    def stop(self):
+        self.running = False
+        self.wakeup()
+
+
+TRANSPORTS = {
+    "snakemq": SnakeMQTransport,
+    "zmq": ZMQTransport,
+}
+
+
+def init_transport(ident, init_type="listen", transport=config.KERNEL_TRANSPORT):
+    try:
+        transport_class = TRANSPORTS[transport]
+    except KeyError:
+        raise ValueError("Unsupported KERNEL_TRANSPORT: %s" % transport)
+    return transport_class(ident, init_type)
@@ -3,33 +3,113 @@
 # webapp is a Flask app (in webapp/main.py relative to this main.py)
 # kernel_program is a Python script (in kernel_program/main.py relative to this main.py)
 
+import time
+LAUNCHED = time.time()
+
+import os
 import sys
+import queue
 import logging
+import shutil
 import asyncio
-import time
+import argparse
+import tempfile
 import webbrowser
 
-from multiprocessing import Process
+from multiprocessing import Process, Queue
 
-from gpt_code_ui.webapp.main import app, APP_PORT
-from gpt_code_ui.kernel_program.main import main as kernel_program_main, cleanup_kernel_program
+import gpt_code_ui.startup as startup
 
+# The apps are only imported by the processes that run them
+APP_PORT = int(os.environ.get("WEB_PORT", 8080))
 APP_URL = "http://localhost:%s" % APP_PORT
 
-def run_webapp():
+# Serve the kernel program's API from the webapp process instead of proxying it over HTTP
+KERNEL_PROGRAM_IN_PROCESS = os.environ.get("KERNEL_PROGRAM_IN_PROCESS", "").lower() in ("1", "true")
+
+# Worker processes and threads per worker of the webapp with --production
+WEB_WORKERS = int(os.environ.get("WEB_WORKERS", 4))
+WEB_THREADS = int(os.environ.get("WEB_THREADS", 16))
+
+def run_webapp(kernel_program_in_process=False, events=None):
+    try:
+        startup.report(events, "webapp", "started")
+        from werkzeug.serving import make_server
+        from gpt_code_ui.webapp.main import app
+        startup.report(events, "webapp", "imported")
+
+        if kernel_program_in_process:
+            from werkzeug.middleware.dispatcher import DispatcherMiddleware
+            import gpt_code_ui.webapp.main as webapp_main
+            import gpt_code_ui.kernel_program.main as kernel_program_main
+
+            kernel_program_main.start_background(events)
+            app.wsgi_app = DispatcherMiddleware(app.wsgi_app, {"/api": kernel_program_main.app})
+            webapp_main.kernel_program = kernel_program_main
+
+        server = make_server("0.0.0.0", APP_PORT, app, threaded=True)
+        # The launcher waits for this instead of polling the webapp
+        startup.report(events, "webapp", "listening")
+        server.serve_forever()
+    except Exception as e:
+        logging.exception("Error running the webapp:")
+        sys.exit(1)
+
+def run_production_webapp(workers, threads, events=None):
+    # State the workers have to share goes to disk, set before they import anything
+    os.environ.setdefault("HISTORY_DIR", os.path.join("workspace", ".history"))
+    metrics_dir = None
+    if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="gpt_code_ui_metrics_")
+
     try:
-        app.run(host="0.0.0.0", port=APP_PORT, use_reloader=False)
+        try:
+            from gpt_code_ui.webapp.server import WebappServer
+        except ImportError:
+            logging.warning("gunicorn is not installed, serving the webapp from a single process. "
+                            "Install it with `pip install gunicorn` to run several workers.")
+            run_webapp(False, events)
+            return
+
+        startup.report(events, "webapp", "started")
+        WebappServer(APP_PORT, workers, threads, events).run()
     except Exception as e:
         logging.exception("Error running the webapp:")
         sys.exit(1)
+    finally:
+        if metrics_dir is not None:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
 
-def run_kernel_program():
+def run_kernel_program(events=None):
     try:
-        asyncio.run(kernel_program_main())
+        startup.report(events, "kernel program", "started")
+        from gpt_code_ui.kernel_program.main import main as kernel_program_main
+        startup.report(events, "kernel program", "imported")
+
+        asyncio.run(kernel_program_main(events))
     except Exception as e:
         logging.exception("Error running the kernel_program:")
         sys.exit(1)
 
+def wait_for_phases(events, processes, phases, timeout=None):
+    """Collect startup timings until all `phases`, (process, phase) pairs, were reported.
+
+    Gives up when a process died or after `timeout` seconds.
+    """
+    timings = []
+    missing = set(phases)
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while missing and all(process.is_alive() for process in processes):
+        if deadline is not None and time.monotonic() > deadline:
+            break
+        try:
+            process, phase, at = events.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        timings.append((process, phase, at))
+        missing.discard((process, phase))
+    return timings
+
 def setup_logging():
     log_format = "%(asctime)s [%(levelname)s]: %(message)s"
     logging.basicConfig(level=logging.INFO, format=log_format)
@@ -66,41 +146,68 @@ def print_banner():
         print_color("Contribute to GPT-Code UI at https://github.com/ricklamers/gpt-code-ui")   
 
 def main():
+    parser = argparse.ArgumentParser(description="GPT-Code UI")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="print how long each startup phase took, once the first kernel is ready")
+    parser.add_argument("--production", action="store_true",
+                        help="serve the webapp with gunicorn from several worker processes")
+    parser.add_argument("--workers", type=int, default=WEB_WORKERS,
+                        help="webapp worker processes with --production (default: %(default)s)")
+    parser.add_argument("--threads", type=int, default=WEB_THREADS,
+                        help="threads per webapp worker with --production (default: %(default)s)")
+    args = parser.parse_args()
+
     setup_logging()
 
-    webapp_process = Process(target=run_webapp)
-    kernel_program_process = Process(target=run_kernel_program)
+    events = Queue()
+    timings = [("launcher", "started", LAUNCHED)]
+
+    kernel_program_in_process = KERNEL_PROGRAM_IN_PROCESS
+    if args.production and kernel_program_in_process:
+        # Every worker would start its own kernel program
+        logging.warning("KERNEL_PROGRAM_IN_PROCESS is ignored with --production")
+        kernel_program_in_process = False
+
+    # The kernel program goes first, its kernel takes the longest to get ready
+    processes = []
+    if not kernel_program_in_process:
+        processes.append(Process(target=run_kernel_program, args=(events,)))
+    if args.production:
+        processes.append(Process(target=run_production_webapp, args=(args.workers, args.threads, events)))
+    else:
+        processes.append(Process(target=run_webapp, args=(kernel_program_in_process, events)))
 
     try:
-        webapp_process.start()
-        kernel_program_process.start()
-
-        # Poll until the webapp is running
-        while True:
-            try:
-                app.test_client().get("/")
-                break
-            except:
-                time.sleep(0.1)
-        
+        for process in processes:
+            process.start()
+        timings.append(("launcher", "processes started", time.time()))
+
+        # Signalled by the webapp once it accepts connections
+        timings += wait_for_phases(events, processes, [("webapp", "listening")])
+
+        if args.profile_startup:
+            timings += wait_for_phases(events, processes, [("kernel program", "kernel ready")], timeout=300)
+            print(startup.format_profile(LAUNCHED, timings))
+
         print_banner()    
         
         webbrowser.open(APP_URL)
 
-        webapp_process.join()
-        kernel_program_process.join()
+        for process in processes:
+            process.join()
 
         
     except KeyboardInterrupt:
         print("Terminating processes...")
-        
+
+        from gpt_code_ui.kernel_program.main import cleanup_kernel_program
         cleanup_kernel_program()
-        kernel_program_process.terminate()
 
-        webapp_process.terminate()
+        for process in processes:
+            process.terminate()
 
-        webapp_process.join()
-        kernel_program_process.join()
+        for process in processes:
+            process.join()
 
         print("Processes terminated.")
         
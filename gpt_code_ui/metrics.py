@@ -0,0 +1,107 @@
+# Prometheus metrics of the webapp and the kernel program, served at /metrics by both
+import os
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+class NoopMetric:
+    """Stands in for every metric when prometheus_client isn't installed."""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def set_function(self, f):
+        pass
+
+
+def metric(metric_type, name, documentation, labelnames=(), **kwargs):
+    if prometheus_client is None:
+        return NoopMetric()
+    return getattr(prometheus_client, metric_type)(name, documentation, labelnames, **kwargs)
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+# Webapp
+llm_request_seconds = metric(
+    "Histogram", "gpt_code_ui_llm_request_seconds",
+    "Time to get code from the LLM, outcome is ok, cached or error",
+    ["model", "outcome"], buckets=LATENCY_BUCKETS)
+llm_tokens = metric(
+    "Histogram", "gpt_code_ui_llm_tokens",
+    "Tokens per LLM request, kind is prompt or completion",
+    ["model", "kind"], buckets=TOKEN_BUCKETS)
+
+# Kernel program
+kernel_execute_seconds = metric(
+    "Histogram", "gpt_code_ui_kernel_execute_seconds",
+    "Time from the kernel starting a cell to it going idle again",
+    ["status"], buckets=LATENCY_BUCKETS)
+result_delay_seconds = metric(
+    "Histogram", "gpt_code_ui_result_delay_seconds",
+    "Time from the kernel publishing output on iopub to it being queued for the client",
+    buckets=LATENCY_BUCKETS)
+result_queue_depth = metric(
+    "Gauge", "gpt_code_ui_result_queue_depth", "Results waiting to be fetched, over all sessions")
+send_queue_depth = metric(
+    "Gauge", "gpt_code_ui_send_queue_depth", "Commands waiting to be sent to kernels")
+execution_queue_depth = metric(
+    "Gauge", "gpt_code_ui_execution_queue_depth", "Cells waiting for their kernel to finish the previous one")
+kernel_count = metric(
+    "Gauge", "gpt_code_ui_kernels", "Running kernels, spares included")
+kernel_rss_bytes = metric(
+    "Gauge", "gpt_code_ui_kernel_rss_bytes", "Resident memory of all kernels")
+kernel_restarts = metric(
+    "Counter", "gpt_code_ui_kernel_restarts", "Kernel restarts requested by clients or the memory watchdog")
+kernel_memory_limit_events = metric(
+    "Counter", "gpt_code_ui_kernel_memory_limit_events",
+    "Memory watchdog interventions, action is interrupt or restart",
+    ["action"])
+processes_killed = metric(
+    "Counter", "gpt_code_ui_processes_killed", "Processes killed by cleanup_spawned_processes",
+    ["process_type"])
+
+
+def process_rss(pid):
+    """Return the resident memory of a process in bytes, 0 if it's gone."""
+    try:
+        if psutil is not None:
+            return psutil.Process(pid).memory_info().rss
+        with open("/proc/%d/statm" % pid) as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        return 0
+
+
+def response():
+    from flask import Response
+
+    if prometheus_client is None:
+        return Response("prometheus_client is not installed\n", 501, mimetype="text/plain")
+
+    registry = prometheus_client.REGISTRY
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        # Served by one of several worker processes, collect what all of them recorded
+        from prometheus_client import multiprocess
+
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(prometheus_client.generate_latest(registry), mimetype=prometheus_client.CONTENT_TYPE_LATEST)
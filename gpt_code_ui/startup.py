@@ -0,0 +1,18 @@
+# Startup phases of the launcher's processes, reported through a multiprocessing queue
+import time
+
+
+def report(events, process, phase, at=None):
+    """Tell the launcher that `process` reached `phase`, a no-op without a queue."""
+    if events is not None:
+        events.put((process, phase, at if at is not None else time.time()))
+
+
+def format_profile(started, timings):
+    """Return the timings as a table of seconds since `started`, in the order they happened."""
+    lines = ["Startup profile, seconds since launch (and since the previous phase):"]
+    previous = started
+    for process, phase, at in sorted(timings, key=lambda t: t[2]):
+        lines.append("  %7.3f  (+%.3f)  %-15s %s" % (at - started, max(0, at - previous), process, phase))
+        previous = max(previous, at)
+    return "\n".join(lines)
@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+
+class CompletionCache:
+    """Caches LLM completions in an in-memory LRU in front of files on disk.
+
+    Entries expire `ttl` seconds after they were stored, reading them
+    doesn't extend that. The memory tier holds at most `max_entries`
+    completions, the disk tier evicts the least recently used files, by
+    their modification time, once it grows beyond `max_bytes`.
+    """
+
+    def __init__(self, directory, max_entries=256, max_bytes=100 * 1024 * 1024, ttl=24 * 3600):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()  # key -> (stored at, content)
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.disk_bytes = sum(size for _, size, _ in self.disk_entries())
+
+    @staticmethod
+    def make_key(model, prompt, temperature):
+        return hashlib.sha256(json.dumps([model, prompt, temperature]).encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        now = time.time()
+
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1]
+
+        try:
+            path = self.path(key)
+            with open(path, encoding="utf-8") as f:
+                stored = json.load(f)
+
+            if now - stored["stored_at"] < self.ttl:
+                # Touch the file, disk eviction goes by modification time
+                os.utime(path)
+                with self.lock:
+                    self.disk_hits += 1
+                self.remember(key, stored["stored_at"], stored["content"])
+                return stored["content"]
+
+            size = os.path.getsize(path)
+            os.remove(path)
+            with self.lock:
+                self.disk_bytes -= size
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, content):
+        stored_at = time.time()
+        self.remember(key, stored_at, content)
+
+        data = json.dumps({"stored_at": stored_at, "content": content}).encode("utf-8")
+        path = self.path(key)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+
+        with self.lock:
+            self.disk_bytes += len(data)
+            evict = self.disk_bytes > self.max_bytes
+        if evict:
+            self.evict_disk()
+
+    def remember(self, key, stored_at, content):
+        with self.lock:
+            self.memory[key] = (stored_at, content)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def disk_entries(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def evict_disk(self):
+        # Expired files first, then the least recently used until 90% of the limit is left.
+        # A file is stored before it's last touched, so one untouched for the ttl has expired,
+        # expired files that were read since are removed by get
+        now = time.time()
+        entries = sorted(self.disk_entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+
+        for path, size, mtime in entries:
+            if total <= self.max_bytes * 0.9 and now - mtime < self.ttl:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+        with self.lock:
+            self.disk_bytes = total
+
+    def stats(self):
+        with self.lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self.memory),
+                "disk_bytes": self.disk_bytes,
+            }
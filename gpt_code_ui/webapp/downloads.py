@@ -0,0 +1,163 @@
+# Streaming downloads of workspace files: byte ranges, compression and zip archives
+import os
+import glob
+import zlib
+import zipfile
+
+from flask import Response, abort, send_from_directory, stream_with_context
+from werkzeug.security import safe_join
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Bytes read from disk at a time
+READ_BUFFER_SIZE = 64 * 1024
+
+# Text formats that shrink well, everything else is sent as it is
+COMPRESSIBLE_EXTENSIONS = {'.csv', '.tsv', '.json', '.jsonl', '.txt', '.xml', '.html', '.md', '.log', '.svg'}
+
+# Smaller files aren't worth the compression overhead
+COMPRESS_MIN_BYTES = 1024
+
+
+def is_compressible(path):
+    return os.path.splitext(path)[1].lower() in COMPRESSIBLE_EXTENSIONS
+
+
+def choose_encoding(accept_encodings, path):
+    """Return the content encoding to compress `path` with, None to send it as is."""
+    if not is_compressible(path) or os.path.getsize(path) < COMPRESS_MIN_BYTES:
+        return None
+    if zstandard is not None and accept_encodings['zstd']:
+        return 'zstd'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def read_chunks(path):
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(READ_BUFFER_SIZE)
+            if not data:
+                return
+            yield data
+
+
+def compress_chunks(path, encoding):
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor().compressobj()
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31: with a gzip header
+
+    for data in read_chunks(path):
+        compressed = compressor.compress(data)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def send_workspace_file(directory, filename, request):
+    """Send a file as an attachment.
+
+    Range requests are answered from the file on disk, so interrupted
+    downloads can be resumed. Otherwise text formats are compressed on the
+    fly when the client accepts it.
+    """
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    encoding = None
+    if request.range is None:
+        encoding = choose_encoding(request.accept_encodings, path)
+
+    if encoding is None:
+        response = send_from_directory(directory, filename, as_attachment=True, conditional=True)
+        response.vary.add('Accept-Encoding')
+        return response
+
+    # The length isn't known up front, the body is sent chunked
+    response = Response(stream_with_context(compress_chunks(path, encoding)), mimetype='application/octet-stream')
+    response.headers['Content-Encoding'] = encoding
+    response.headers.set('Content-Disposition', 'attachment', filename=os.path.basename(path))
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def find_workspace_files(directory, files=(), patterns=()):
+    """Return the relative paths of `files` and of the files matching `patterns`.
+
+    Hidden files and directories are skipped, as are paths outside of `directory`.
+    """
+    found = []
+    for filename in files:
+        path = safe_join(directory, filename)
+        if path is not None and os.path.isfile(path):
+            found.append(os.path.relpath(path, directory))
+
+    for pattern in patterns:
+        if safe_join(directory, pattern) is None:
+            continue
+        # Not glob's root_dir, that needs Python 3.10
+        for path in sorted(glob.glob(os.path.join(glob.escape(directory), pattern), recursive=True)):
+            if os.path.isfile(path):
+                found.append(os.path.relpath(path, directory))
+
+    # Keep the first occurrence of every file
+    return [filename for filename in dict.fromkeys(found) if not is_hidden(filename)]
+
+
+def is_hidden(filename):
+    return any(part.startswith('.') for part in filename.split(os.sep))
+
+
+class StreamWriter:
+    """Unseekable file object that collects what zipfile writes, until it's taken."""
+
+    def __init__(self):
+        self.buffer = []
+        self.position = 0
+
+    def write(self, data):
+        self.buffer.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.buffer)
+        self.buffer = []
+        return data
+
+
+def zip_chunks(directory, filenames):
+    # zipfile writes data descriptors after every member when it can't seek
+    # back, so the archive never has to exist as a whole
+    writer = StreamWriter()
+    with zipfile.ZipFile(writer, 'w') as archive:
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            info = zipfile.ZipInfo.from_file(path, filename)
+            info.compress_type = zipfile.ZIP_DEFLATED if is_compressible(path) else zipfile.ZIP_STORED
+
+            with archive.open(info, 'w', force_zip64=True) as member:
+                for data in read_chunks(path):
+                    member.write(data)
+                    yield writer.take()
+            yield writer.take()
+    yield writer.take()
+
+
+def send_workspace_zip(directory, filenames, name='files.zip'):
+    response = Response(stream_with_context(chunk for chunk in zip_chunks(directory, filenames) if chunk),
+                        mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename=name)
+    return response
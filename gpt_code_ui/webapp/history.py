@@ -0,0 +1,305 @@
+import os
+import ast
+import json
+import time
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Used when tiktoken isn't installed or doesn't know the model, English text
+# and code average about four characters per token
+CHARS_PER_TOKEN = 4
+
+encodings = {}
+encodings_lock = threading.Lock()
+
+
+def get_encoding(model):
+    if tiktoken is None:
+        return None
+
+    with encodings_lock:
+        if model not in encodings:
+            try:
+                encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                # Azure deployment names and other unknown models
+                encodings[model] = tiktoken.get_encoding("cl100k_base")
+        return encodings[model]
+
+
+def count_tokens(text, model):
+    encoding = get_encoding(model)
+    if encoding is None:
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def shorten(text, max_chars):
+    text = " ".join(text.split())
+    return text if len(text) <= max_chars else text[:max_chars - 3] + "..."
+
+
+def summarize_code(code):
+    """Describe what code did in a line: the names it defined, what it imported and the files it named."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return "code that didn't parse"
+
+    defined, imported, files = [], [], []
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            defined.append(node.name)
+        elif isinstance(node, (ast.Assign, ast.AugAssign, ast.AnnAssign)):
+            for target in (node.targets if isinstance(node, ast.Assign) else [node.target]):
+                defined.extend(n.id for n in ast.walk(target) if isinstance(n, ast.Name))
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            imported.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.Constant) and isinstance(node.value, str) and "." in node.value[-6:] \
+                and " " not in node.value and len(node.value) < 100:
+            # Looks like a file name, e.g. the argument of read_csv or savefig
+            files.append(node.value)
+
+    parts = []
+    for label, names in (("defined", defined), ("imported", imported), ("files", files)):
+        names = list(dict.fromkeys(names))
+        if names:
+            parts.append("%s %s" % (label, ", ".join(names[:10]) + (", ..." if len(names) > 10 else "")))
+    return "; ".join(parts) or "code without definitions"
+
+
+def open_locked(path):
+    """Open `path` for appending, locked against other processes, reopening it if it was replaced meanwhile."""
+    while True:
+        f = open(path, "ab")
+        if fcntl is None:
+            return f
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                return f
+        except FileNotFoundError:
+            pass
+        f.close()
+
+
+class Turn:
+    """A request and the code it produced, or context like an upload notice."""
+
+    def __init__(self, prompt, code=None, context=False):
+        self.prompt = prompt
+        self.code = code
+        self.context = context
+
+        self._summary = None
+        self._tokens = {}  # (model, summarized) -> token count
+
+    def to_json(self):
+        return json.dumps({"prompt": self.prompt, "code": self.code, "context": self.context})
+
+    def verbatim(self):
+        if self.context:
+            return "Context: %s" % self.prompt.strip()
+        if self.code is None:
+            return "User: %s" % self.prompt.strip()
+        return "User: %s\nCode:\n```python\n%s\n```" % (self.prompt.strip(), self.code.strip())
+
+    def summary(self):
+        # Computed once, older turns are rendered on every request
+        if self._summary is None:
+            if self.context:
+                self._summary = "- Context: %s" % shorten(self.prompt, 200)
+            elif self.code is None:
+                self._summary = "- Asked: %s" % shorten(self.prompt, 200)
+            else:
+                self._summary = "- Asked: %s -> %s" % (shorten(self.prompt, 200), summarize_code(self.code))
+        return self._summary
+
+    def tokens(self, model, summarized):
+        key = (model, summarized)
+        if key not in self._tokens:
+            self._tokens[key] = count_tokens(self.summary() if summarized else self.verbatim(), model)
+        return self._tokens[key]
+
+
+class ConversationHistory:
+    """The turns of one conversation, rendered for the prompt within a token budget.
+
+    The `recent_turns` newest turns are kept verbatim, code included, as long
+    as they fit. Older turns are compacted into one line summaries, which are
+    cached on the turn. Whatever doesn't fit the budget any more is left out,
+    oldest first.
+
+    With a `path` the turns are appended to that file as JSON lines, so every
+    process serving the session sees them. Each process only reads the lines
+    that were added since it last looked.
+    """
+
+    def __init__(self, token_budget=1000, recent_turns=3, max_turns=200, path=None):
+        self.token_budget = token_budget
+        self.recent_turns = recent_turns
+        self.max_turns = max_turns
+        self.path = path
+
+        self.lock = threading.Lock()
+        self.turns = []
+
+        # How far the file was read, a new inode means it was compacted
+        self.inode = None
+        self.offset = 0
+        self.lines = 0
+
+    def add(self, prompt, code=None, context=False):
+        turn = Turn(prompt, code, context)
+        with self.lock:
+            if self.path is None:
+                self.turns.append(turn)
+                del self.turns[:-self.max_turns]
+                return
+
+            with open_locked(self.path) as f:
+                f.write(turn.to_json().encode("utf-8") + b"\n")
+            self.load()
+            if self.lines > 2 * self.max_turns:
+                self.compact()
+
+    def load(self):
+        """Read the turns appended to the file since the last call."""
+        try:
+            with open(self.path, "rb") as f:
+                inode = os.fstat(f.fileno()).st_ino
+                if inode != self.inode:
+                    self.inode, self.offset, self.lines = inode, 0, 0
+                    self.turns = []
+
+                f.seek(self.offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # still being written
+                    self.offset += len(line)
+                    self.lines += 1
+                    try:
+                        self.turns.append(Turn(**json.loads(line)))
+                    except (ValueError, TypeError):
+                        pass
+        except FileNotFoundError:
+            self.inode, self.offset, self.lines = None, 0, 0
+            self.turns = []
+
+        del self.turns[:-self.max_turns]
+
+    def compact(self):
+        # Keeps the file at most twice as long as needed, appends wait on the lock meanwhile
+        with open_locked(self.path):
+            self.load()
+            tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                f.writelines(turn.to_json().encode("utf-8") + b"\n" for turn in self.turns)
+            os.replace(tmp_path, self.path)
+
+    def render(self, model, digest=None):
+        """Return the history as text, followed by the `digest` of the last execution if given."""
+        budget = self.token_budget
+        digest_text = "Output of the last code that ran:\n%s" % digest if digest else ""
+        if digest_text:
+            budget -= count_tokens(digest_text, model)
+
+        with self.lock:
+            if self.path is not None:
+                self.load()
+            turns = list(self.turns)
+
+        recent, summarized = [], []
+        for age, turn in enumerate(reversed(turns)):
+            if age < self.recent_turns and not summarized and turn.tokens(model, False) <= budget:
+                recent.append(turn.verbatim())
+                budget -= turn.tokens(model, False)
+            elif turn.tokens(model, True) <= budget:
+                summarized.append(turn.summary())
+                budget -= turn.tokens(model, True)
+            else:
+                summarized.append("- %d earlier requests left out" % (len(turns) - age))
+                break
+
+        sections = []
+        if summarized:
+            sections.append("Earlier requests, summarized:\n" + "\n".join(reversed(summarized)))
+        if recent:
+            sections.append("\n\n".join(reversed(recent)))
+        if digest_text:
+            sections.append(digest_text)
+        return "\n\n".join(sections)
+
+
+class HistoryStore:
+    """The histories of the most recently active sessions.
+
+    Kept in memory, or with a `directory` in one file per session there, which
+    is shared by all processes using the directory. Files of sessions that
+    weren't active for `expiry` seconds are removed.
+    """
+
+    def __init__(self, directory=None, max_sessions=1000, expiry=7 * 24 * 3600, **history_options):
+        self.directory = directory
+        self.max_sessions = max_sessions
+        self.expiry = expiry
+        self.history_options = history_options
+        self.lock = threading.Lock()
+        self.histories = OrderedDict()  # session -> ConversationHistory
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, session):
+        # Session ids come from the client, they don't go into the file name as they are
+        return os.path.join(self.directory, hashlib.sha256(session.encode("utf-8")).hexdigest() + ".jsonl")
+
+    def remove_expired(self):
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                if now - entry.stat().st_mtime > self.expiry:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def get(self, session):
+        with self.lock:
+            history = self.histories.get(session)
+            if history is None:
+                path = None
+                if self.directory is not None:
+                    self.remove_expired()
+                    path = self.path(session)
+                history = self.histories[session] = ConversationHistory(path=path, **self.history_options)
+                while len(self.histories) > self.max_sessions:
+                    self.histories.popitem(last=False)
+            self.histories.move_to_end(session)
+            return history
+
+
+def describe_execution(record):
+    """Return a short digest of an execution record of the kernel program, None if there is nothing to say."""
+    if record is None or record.get("state") != "done":
+        return None
+
+    lines = ["Status: %s" % record.get("status")]
+    if record.get("output_head"):
+        lines.append(record["output_head"].rstrip())
+    if record.get("output_tail"):
+        lines.append("...\n" + record["output_tail"].rstrip())
+    if record.get("images"):
+        lines.append("(%d image%s)" % (record["images"], "s" if record["images"] > 1 else ""))
+    return "\n".join(lines)
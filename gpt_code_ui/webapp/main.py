@@ -6,16 +6,24 @@ import json
 import re
 import logging
 import sys
+import queue
+import threading
+import time
 import openai
-import pandas as pd
-
-from collections import deque
 
 from flask_cors import CORS
-from flask import Flask, request, jsonify, send_from_directory, Response
+from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context, abort
 from dotenv import load_dotenv
 
-from gpt_code_ui.kernel_program.main import APP_PORT as KERNEL_APP_PORT
+import gpt_code_ui.kernel_program.config as kernel_program_config
+import gpt_code_ui.kernel_program.blob_store as blob_store
+import gpt_code_ui.metrics as metrics
+from gpt_code_ui.webapp.completion_cache import CompletionCache
+from gpt_code_ui.webapp.schema import inspect_schema, describe_schema
+from gpt_code_ui.webapp.uploads import UploadStore, UploadError
+from gpt_code_ui.webapp.downloads import send_workspace_file, find_workspace_files, send_workspace_zip
+from gpt_code_ui.webapp.workspace_index import WorkspaceIndex
+from gpt_code_ui.webapp.history import HistoryStore, describe_execution
 
 load_dotenv('.env')
 
@@ -36,29 +44,48 @@ else:
 UPLOAD_FOLDER = 'workspace/'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+upload_store = UploadStore(
+    UPLOAD_FOLDER,
+    chunk_size=int(os.environ.get("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024)),
+    expiry=float(os.environ.get("UPLOAD_EXPIRY", 24 * 3600)),
+)
 
-APP_PORT = int(os.environ.get("WEB_PORT", 8080))
-
+workspace_index = WorkspaceIndex(
+    UPLOAD_FOLDER,
+    scan_interval=float(os.environ.get("WORKSPACE_SCAN_INTERVAL", 2)),
+)
 
-class LimitedLengthString:
-    def __init__(self, maxlen=2000):
-        self.data = deque()
-        self.len = 0
-        self.maxlen = maxlen
+APP_PORT = int(os.environ.get("WEB_PORT", 8080))
+KERNEL_APP_PORT = kernel_program_config.API_PORT
+
+# Opt-in cache of completions, for identical prompts against identical history
+if os.environ.get("COMPLETION_CACHE", "").lower() in ("1", "true"):
+    completion_cache = CompletionCache(
+        os.environ.get("COMPLETION_CACHE_DIR", ".completion_cache"),
+        max_entries=int(os.environ.get("COMPLETION_CACHE_MAX_ENTRIES", 256)),
+        max_bytes=int(os.environ.get("COMPLETION_CACHE_MAX_BYTES", 100 * 1024 * 1024)),
+        ttl=float(os.environ.get("COMPLETION_CACHE_TTL", 24 * 3600)),
+    )
+else:
+    completion_cache = None
 
-    def append(self, string):
-        self.data.append(string)
-        self.len += len(string)
-        while self.len > self.maxlen:
-            popped = self.data.popleft()
-            self.len -= len(popped)
+# Keep-alive connections to the kernel program, shared by all request threads
+kernel_program_session = requests.Session()
+kernel_program_session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=32))
 
-    def get_string(self):
-        result = ''.join(self.data)
-        return result[-self.maxlen:]
+# The kernel program's module when it's served from this process (KERNEL_PROGRAM_IN_PROCESS),
+# nothing listens on its port then
+kernel_program = None
 
 
-message_buffer = LimitedLengthString()
+# Conversation history per session, rendered into the prompt within a token budget.
+# Kept in HISTORY_DIR when it's set, which the webapp's workers need to share it.
+history_store = HistoryStore(
+    os.environ.get("HISTORY_DIR") or None,
+    expiry=float(os.environ.get("HISTORY_EXPIRY", 7 * 24 * 3600)),
+    token_budget=int(os.environ.get("HISTORY_TOKEN_BUDGET", 1000)),
+    recent_turns=int(os.environ.get("HISTORY_RECENT_TURNS", 3)),
+)
 
 
 def allowed_file(filename):
@@ -66,38 +93,45 @@ def allowed_file(filename):
 
 
 def inspect_file(filename: str) -> str:
-    READER_MAP = {
-        '.csv': pd.read_csv,
-        '.tsv': pd.read_csv,
-        '.xlsx': pd.read_excel,
-        '.xls': pd.read_excel,
-        '.xml': pd.read_xml,
-        '.json': pd.read_json,
-        '.hdf': pd.read_hdf,
-        '.hdf5': pd.read_hdf,
-        '.feather': pd.read_feather,
-        '.parquet': pd.read_parquet,
-        '.pkl': pd.read_pickle,
-        '.sql': pd.read_sql,
-    }
-
-    _, ext = os.path.splitext(filename)
+    return describe_schema(inspect_schema(filename))
 
-    try:
-        df = READER_MAP[ext.lower()](filename)
-        return f'The file contains the following columns: {", ".join(df.columns)}'
-    except KeyError:
-        return ''  # unsupported file type
-    except Exception:
-        return ''  # file reading failed. - Don't want to know why.
 
+def get_session():
+    return request.args.get('session', kernel_program_config.DEFAULT_SESSION)
 
-async def get_code(user_prompt, user_openai_key=None, model="gpt-3.5-turbo"):
 
-    prompt = f"""First, here is a history of what I asked you to do earlier. 
+def last_execution_digest(session):
+    """Return a digest of the session's last finished execution, None if the kernel program doesn't know one."""
+    if kernel_program is not None:
+        records = kernel_program.execution_log.list(session, 5)
+    else:
+        try:
+            response = kernel_program_session.get(
+                f'http://localhost:{KERNEL_APP_PORT}/executions',
+                params={'session': session, 'limit': 5},
+                timeout=2,
+            )
+            records = response.json()['executions']
+        except (requests.RequestException, ValueError, KeyError):
+            return None
+
+    # Quiet executions, like idle checkpoints, weren't asked for
+    for record in records:
+        if not record.get('quiet') and record.get('state') == 'done':
+            return describe_execution(record)
+    return None
+
+
+def render_history(session, model):
+    # Done in the request thread, not on the LLM loop, as it asks the kernel program
+    return history_store.get(session).render(model or "", last_execution_digest(session))
+
+
+def build_prompt(user_prompt, history):
+    return f"""First, here is a history of what I asked you to do earlier. 
     The actual prompt follows after ENDOFHISTORY. 
     History:
-    {message_buffer.get_string()}
+    {history}
     ENDOFHISTORY.
     Write Python code, in a triple backtick Markdown code block, that does the following:
     {user_prompt}
@@ -123,9 +157,8 @@ async def get_code(user_prompt, user_openai_key=None, model="gpt-3.5-turbo"):
     
     Teacher mode: if the code modifies or produces a file, at the end of the code block insert a print statement that prints a link to it as HTML string: <a href='/download?file=INSERT_FILENAME_HERE'>Download file</a>. Replace INSERT_FILENAME_HERE with the actual filename."""
 
-    if user_openai_key:
-        openai.api_key = user_openai_key
 
+def build_arguments(prompt, model, api_key=None):
     arguments = dict(
         temperature=0.7,
         headers=OPENAI_EXTRA_HEADERS,
@@ -135,15 +168,87 @@ async def get_code(user_prompt, user_openai_key=None, model="gpt-3.5-turbo"):
         ]
     )
 
+    # Per request rather than on the openai module, which all requests share
+    if api_key:
+        arguments["api_key"] = api_key
+
     if openai.api_type == 'open_ai':
         arguments["model"] = model
     elif openai.api_type == 'azure':
         arguments["deployment_id"] = model
     else:
+        return None
+
+    return arguments
+
+
+def extract_code(text, fenced_only=False):
+    # Match triple backtick blocks first
+    triple_match = re.search(r'```(?:\w+\n)?(.+?)```', text, re.DOTALL)
+    if triple_match:
+        return triple_match.group(1).strip()
+    elif not fenced_only:
+        # If no triple backtick blocks, match single backtick blocks
+        single_match = re.search(r'`(.+?)`', text, re.DOTALL)
+        if single_match:
+            return single_match.group(1).strip()
+
+
+# All completions run on one shared event loop, so waiting on the LLM doesn't
+# hold a thread per request. Started lazily, threads don't survive a fork.
+llm_loop = None
+llm_loop_lock = threading.Lock()
+
+
+def run_on_llm_loop(coro):
+    global llm_loop
+
+    with llm_loop_lock:
+        if llm_loop is None:
+            llm_loop = asyncio.new_event_loop()
+            threading.Thread(target=llm_loop.run_forever, daemon=True).start()
+
+    return asyncio.run_coroutine_threadsafe(coro, llm_loop)
+
+
+def get_cache_key(arguments, use_cache):
+    if completion_cache is None:
+        return None, None
+
+    key = completion_cache.make_key(
+        arguments.get("model", arguments.get("deployment_id")),
+        arguments["messages"],
+        arguments["temperature"],
+    )
+    # Bypassing skips the lookup, the fresh answer still replaces the cached one
+    return key, completion_cache.get(key) if use_cache else None
+
+
+def record_llm_request(model, outcome, started, prompt_tokens=None, completion_tokens=None):
+    model = model or "unknown"
+    metrics.llm_request_seconds.labels(model, outcome).observe(time.monotonic() - started)
+    if prompt_tokens is not None:
+        metrics.llm_tokens.labels(model, "prompt").observe(prompt_tokens)
+    if completion_tokens is not None:
+        metrics.llm_tokens.labels(model, "completion").observe(completion_tokens)
+
+
+async def get_code(user_prompt, history, user_openai_key=None, model="gpt-3.5-turbo", use_cache=True):
+    started = time.monotonic()
+
+    prompt = build_prompt(user_prompt, history)
+
+    arguments = build_arguments(prompt, model, user_openai_key)
+    if arguments is None:
         return None, f"Error: Invalid OPENAI_PROVIDER: {openai.api_type}", 500
 
+    cache_key, content = get_cache_key(arguments, use_cache)
+    if content is not None:
+        record_llm_request(model, "cached", started)
+        return extract_code(content), content.strip(), 200
+
     try:
-        result_GPT = openai.ChatCompletion.create(**arguments)
+        result_GPT = await openai.ChatCompletion.acreate(**arguments)
 
         if 'error' in result_GPT:
             raise openai.APIError(code=result_GPT.error.code, message=result_GPT.error.message)
@@ -152,27 +257,92 @@ async def get_code(user_prompt, user_openai_key=None, model="gpt-3.5-turbo"):
             raise openai.APIError('Content Filter')
 
     except openai.OpenAIError as e:
+        record_llm_request(model, "error", started)
         return None, f"Error from API: {e}", 500
 
     try:
         content = result_GPT.choices[0].message.content
 
     except AttributeError:
+        record_llm_request(model, "error", started)
         return None, f"Malformed answer from API: {content}", 500
 
-    def extract_code(text):
-        # Match triple backtick blocks first
-        triple_match = re.search(r'```(?:\w+\n)?(.+?)```', text, re.DOTALL)
-        if triple_match:
-            return triple_match.group(1).strip()
-        else:
-            # If no triple backtick blocks, match single backtick blocks
-            single_match = re.search(r'`(.+?)`', text, re.DOTALL)
-            if single_match:
-                return single_match.group(1).strip()
+    usage = result_GPT.get('usage') or {}
+    record_llm_request(model, "ok", started, usage.get('prompt_tokens'), usage.get('completion_tokens'))
+
+    if cache_key is not None:
+        completion_cache.put(cache_key, content)
 
     return extract_code(content), content.strip(), 200
 
+
+async def stream_code(user_prompt, history, emit, user_openai_key=None, model="gpt-3.5-turbo", use_cache=True):
+    """Like get_code, but reports progress through `emit(event_type, value)`.
+
+    Emits a "text" event for every token delta and a "code" event as soon as
+    the closing backticks of the code block came in.
+    """
+    started = time.monotonic()
+
+    prompt = build_prompt(user_prompt, history)
+
+    arguments = build_arguments(prompt, model, user_openai_key)
+    if arguments is None:
+        return None, f"Error: Invalid OPENAI_PROVIDER: {openai.api_type}", 500
+
+    cache_key, content = get_cache_key(arguments, use_cache)
+    if content is not None:
+        code = extract_code(content)
+        emit('text', content)
+        if code is not None:
+            emit('code', code)
+        record_llm_request(model, "cached", started)
+        return code, content.strip(), 200
+
+    content = ''
+    code = None
+    # Streamed answers carry no usage, every content chunk is about one token
+    chunks = 0
+
+    try:
+        async for chunk in await openai.ChatCompletion.acreate(stream=True, **arguments):
+            if 'error' in chunk:
+                raise openai.APIError(code=chunk.error.code, message=chunk.error.message)
+
+            # Azure sends chunks without choices for its content filter results
+            if not chunk.choices:
+                continue
+
+            if chunk.choices[0].finish_reason == 'content_filter':
+                raise openai.APIError('Content Filter')
+
+            delta = chunk.choices[0].delta.get('content')
+            if not delta:
+                continue
+
+            content += delta
+            chunks += 1
+            emit('text', delta)
+
+            if code is None:
+                code = extract_code(content, fenced_only=True)
+                if code is not None:
+                    emit('code', code)
+
+    except openai.OpenAIError as e:
+        record_llm_request(model, "error", started)
+        return None, f"Error from API: {e}", 500
+
+    record_llm_request(model, "ok", started, completion_tokens=chunks)
+
+    if cache_key is not None:
+        completion_cache.put(cache_key, content)
+
+    if code is None:
+        code = extract_code(content)
+
+    return code, content.strip(), 200
+
 # We know this Flask app is for local use. So we can disable the verbose Werkzeug logger
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
@@ -203,19 +373,30 @@ def models():
 
 @app.route('/api/<path:path>', methods=["GET", "POST"])
 def proxy_kernel_manager(path):
-    if request.method == "POST":
-        resp = requests.post(
-            f'http://localhost:{KERNEL_APP_PORT}/{path}', json=request.get_json())
-    else:
-        resp = requests.get(f'http://localhost:{KERNEL_APP_PORT}/{path}')
+    # Always stream: results and images are relayed as they are read instead of
+    # being buffered, and the never ending event stream works the same way
+    resp = kernel_program_session.request(
+        request.method,
+        f'http://localhost:{KERNEL_APP_PORT}/{path}',
+        params=request.args,
+        data=request.get_data() if request.method == "POST" else None,
+        headers={"Content-Type": request.content_type} if request.content_type else None,
+        stream=True,
+    )
 
     excluded_headers = ['content-encoding',
                         'content-length', 'transfer-encoding', 'connection']
     headers = [(name, value) for (name, value) in resp.raw.headers.items()
                if name.lower() not in excluded_headers]
 
-    response = Response(resp.content, resp.status_code, headers)
-    return response
+    def relay():
+        try:
+            yield from resp.iter_content(chunk_size=None)
+        finally:
+            # Hands the connection back to the pool once the body was consumed
+            resp.close()
+
+    return Response(stream_with_context(relay()), resp.status_code, headers)
 
 
 @app.route('/assets/<path:path>')
@@ -223,22 +404,62 @@ def serve_static(path):
     return send_from_directory('static/assets/', path)
 
 
+@app.route('/blobs/<name>')
+def serve_blob(name):
+    if not blob_store.is_blob_name(name):
+        abort(404)
+
+    # Blobs are content-addressed, so they never change under their name
+    response = send_from_directory(
+        os.path.abspath(kernel_program_config.BLOB_DIR), name,
+        etag=name.split('.')[0], max_age=365 * 24 * 3600)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
 @app.route('/download')
 def download_file():
 
     # Get query argument file
     file = request.args.get('file')
-    # from `workspace/` send the file
-    # make sure to set required headers to make it download the file
-    return send_from_directory(os.path.join(os.getcwd(), 'workspace'), file, as_attachment=True)
+    # from `workspace/` send the file, resumable and compressed where it helps
+    return send_workspace_file(os.path.join(os.getcwd(), 'workspace'), file, request)
+
+
+@app.route('/download-zip')
+def download_zip():
+    # Any number of `file` and `glob` query arguments, e.g. ?glob=*.csv&file=chart.png
+    directory = os.path.join(os.getcwd(), 'workspace')
+    files = find_workspace_files(directory, request.args.getlist('file'), request.args.getlist('glob'))
+    if not files:
+        return jsonify({'error': 'No matching files'}), 404
+
+    return send_workspace_zip(directory, files, request.args.get('name', 'files.zip'))
+
+
+@app.route('/workspace/files')
+def list_workspace_files():
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', 100, type=int), 0), 1000)
+
+    total, files = workspace_index.list(
+        offset=offset,
+        limit=limit,
+        pattern=request.args.get('glob'),
+        file_type=request.args.get('type'),
+        sort=request.args.get('sort', 'name'),
+        descending=request.args.get('order') == 'desc',
+        with_schema=request.args.get('schema', '1') != '0',
+    )
+    return jsonify({'total': total, 'offset': offset, 'limit': limit, 'files': files})
 
 
 @app.route('/inject-context', methods=['POST'])
 def inject_context():
     user_prompt = request.json.get('prompt', '')
 
-    # Append all messages to the message buffer for later use
-    message_buffer.append(user_prompt + "\n\n")
+    history_store.get(get_session()).add(user_prompt, context=True)
 
     return jsonify({"result": "success"})
 
@@ -248,20 +469,72 @@ def generate_code():
     user_prompt = request.json.get('prompt', '')
     user_openai_key = request.json.get('openAIKey', None)
     model = request.json.get('model', None)
+    use_cache = not request.json.get('noCache', False)
+    session = get_session()
 
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-
-    code, text, status = loop.run_until_complete(
-        get_code(user_prompt, user_openai_key, model))
-    loop.close()
+    code, text, status = run_on_llm_loop(
+        get_code(user_prompt, render_history(session, model), user_openai_key, model, use_cache)).result()
 
-    # Append all messages to the message buffer for later use
-    message_buffer.append(user_prompt + "\n\n")
+    # The generated code is kept too, later prompts can build on it
+    history_store.get(session).add(user_prompt, code)
 
     return jsonify({'code': code, 'text': text}), status
 
 
+@app.route('/generate-stream', methods=['POST'])
+def generate_code_stream():
+    user_prompt = request.json.get('prompt', '')
+    user_openai_key = request.json.get('openAIKey', None)
+    model = request.json.get('model', None)
+    use_cache = not request.json.get('noCache', False)
+    session = get_session()
+    history = render_history(session, model)
+
+    # Newline delimited JSON events, the last one carries the complete answer
+    events = queue.Queue()
+
+    def emit(event_type, value):
+        events.put({'type': event_type, 'value': value})
+
+    future = run_on_llm_loop(
+        stream_code(user_prompt, history, emit, user_openai_key, model, use_cache))
+    future.add_done_callback(lambda _: events.put(None))
+
+    def generate():
+        try:
+            for event in iter(events.get, None):
+                yield json.dumps(event) + "\n"
+
+            try:
+                code, text, status = future.result()
+            except Exception as e:
+                logging.exception("Error generating code:")
+                code, text, status = None, f"Error: {e}", 500
+
+            # The generated code is kept too, later prompts can build on it
+            history_store.get(session).add(user_prompt, code)
+
+            yield json.dumps({'type': 'done', 'code': code, 'text': text, 'status': status}) + "\n"
+        finally:
+            # Stop generating when the client went away
+            future.cancel()
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return metrics.response()
+
+
+@app.route('/completion-cache')
+def completion_cache_stats():
+    if completion_cache is None:
+        return jsonify({'enabled': False})
+
+    return jsonify(dict(completion_cache.stats(), enabled=True))
+
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     # check if the post request has the file part
@@ -275,11 +548,51 @@ def upload_file():
     if file and allowed_file(file.filename):
         file_target = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
         file.save(file_target)
-        file_info = inspect_file(file_target)
-        return jsonify({'message': f'File {file.filename} uploaded successfully.\n{file_info}'}), 200
+        return jsonify(upload_result(file.filename, file_target)), 200
     else:
         return jsonify({'error': 'File type not allowed'}), 400
 
 
+def upload_result(filename, file_target):
+    schema = inspect_schema(file_target)
+    file_info = describe_schema(schema)
+    return {'message': f'File {filename} uploaded successfully.\n{file_info}', 'schema': schema}
+
+
+@app.errorhandler(UploadError)
+def upload_error(e):
+    return jsonify(dict(e.details, error=str(e))), e.status
+
+
+@app.route('/upload/init', methods=['POST'])
+def upload_init():
+    filename = request.json.get('filename', '')
+    if not allowed_file(filename):
+        return jsonify({'error': 'File type not allowed'}), 400
+
+    state = upload_store.init(filename, request.json.get('size'), request.json.get('chunkSize'))
+    return jsonify(state), 200
+
+
+@app.route('/upload/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    # Tells a resuming client which chunk to send next
+    return jsonify(upload_store.status(upload_id)), 200
+
+
+@app.route('/upload/<upload_id>/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    # The body is read in small pieces, a chunk is never held in memory as a whole
+    state = upload_store.put_chunk(upload_id, index, request.stream)
+    return jsonify(state), 200
+
+
+@app.route('/upload/<upload_id>/complete', methods=['POST'])
+def upload_complete(upload_id):
+    file_target, digest, deduplicated = upload_store.complete(upload_id)
+    result = upload_result(os.path.basename(file_target), file_target)
+    return jsonify(dict(result, sha256=digest, deduplicated=deduplicated)), 200
+
+
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=APP_PORT, debug=True, use_reloader=False)
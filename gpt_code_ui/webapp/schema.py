@@ -0,0 +1,167 @@
+# Cheap schema inspection of data files, reads only what is needed to list columns
+import os
+import functools
+
+# Rows read to infer column types
+SAMPLE_ROWS = 1000
+
+# Bytes read from the start of a text file to estimate its row count
+ROW_ESTIMATE_BYTES = 1024 * 1024
+
+# Formats without cheap metadata are only loaded in full up to this size
+FULL_READ_MAX_BYTES = 50 * 1024 * 1024
+
+# pandas readers by name, pandas is only imported once a file needs inspecting
+FULL_READERS = {
+    '.xml': 'read_xml',
+    '.json': 'read_json',
+    '.hdf': 'read_hdf',
+    '.hdf5': 'read_hdf',
+    '.pkl': 'read_pickle',
+    '.sql': 'read_sql',
+}
+
+
+def inspect_schema(path):
+    """Return columns, dtypes, row count and size of a data file, None if unsupported.
+
+    Results are cached until the file's modification time or size changes.
+    """
+    stat = os.stat(path)
+    return _inspect_schema(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=1024)
+def _inspect_schema(path, mtime_ns, size):
+    import pandas as pd
+
+    _, ext = os.path.splitext(path)
+    ext = ext.lower()
+
+    try:
+        if ext in ('.csv', '.tsv'):
+            schema = sniff_csv(path, size, sep='\t' if ext == '.tsv' else ',')
+        elif ext == '.jsonl':
+            schema = sniff_json_lines(path, size)
+        elif ext == '.parquet':
+            schema = sniff_parquet(path)
+        elif ext == '.feather':
+            schema = sniff_feather(path)
+        elif ext in ('.xlsx', '.xls'):
+            schema = sniff_excel(path)
+        elif ext in FULL_READERS and size <= FULL_READ_MAX_BYTES:
+            schema = from_frame(getattr(pd, FULL_READERS[ext])(path), len_is_exact=True)
+        else:
+            return None  # unsupported file type
+    except Exception:
+        return None  # file reading failed. - Don't want to know why.
+
+    schema['format'] = ext.lstrip('.')
+    schema['size'] = size
+    return schema
+
+
+def from_frame(df, rows=None, len_is_exact=False):
+    return {
+        'columns': [str(c) for c in df.columns],
+        'dtypes': {str(c): str(t) for c, t in df.dtypes.items()},
+        'rows': len(df) if len_is_exact else rows,
+        'rows_estimated': not len_is_exact and rows is not None,
+    }
+
+
+def estimate_lines(path, size):
+    """Return the number of lines in a text file, exact if it's read completely."""
+    with open(path, 'rb') as f:
+        head = f.read(ROW_ESTIMATE_BYTES)
+
+    lines = head.count(b'\n') + (0 if head.endswith(b'\n') or not head else 1)
+    if len(head) >= size or lines == 0:
+        return lines, False
+    return int(size / (len(head) / lines)), True
+
+
+def sniff_csv(path, size, sep=','):
+    import pandas as pd
+    df = pd.read_csv(path, sep=sep, nrows=SAMPLE_ROWS)
+    lines, estimated = estimate_lines(path, size)
+
+    schema = from_frame(df, rows=max(lines - 1, 0))  # minus the header
+    schema['rows_estimated'] = estimated
+    return schema
+
+
+def sniff_json_lines(path, size):
+    import pandas as pd
+    df = pd.read_json(path, lines=True, nrows=SAMPLE_ROWS)
+    lines, estimated = estimate_lines(path, size)
+
+    schema = from_frame(df, rows=lines)
+    schema['rows_estimated'] = estimated
+    return schema
+
+
+def sniff_parquet(path):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        import pandas as pd
+        return from_frame(pd.read_parquet(path), len_is_exact=True)
+
+    # Only the footer is read
+    parquet_file = pq.ParquetFile(path)
+    schema = parquet_file.schema_arrow
+    return {
+        'columns': list(schema.names),
+        'dtypes': {field.name: str(field.type) for field in schema},
+        'rows': parquet_file.metadata.num_rows,
+        'rows_estimated': False,
+    }
+
+
+def sniff_feather(path):
+    try:
+        import pyarrow as pa
+    except ImportError:
+        import pandas as pd
+        return from_frame(pd.read_feather(path), len_is_exact=True)
+
+    # Memory mapped, batches are only touched for their lengths
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        rows = sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+        return {
+            'columns': list(reader.schema.names),
+            'dtypes': {field.name: str(field.type) for field in reader.schema},
+            'rows': rows,
+            'rows_estimated': False,
+        }
+
+
+def sniff_excel(path):
+    import pandas as pd
+
+    # The first sheet only, pandas stops reading after nrows
+    df = pd.read_excel(path, nrows=SAMPLE_ROWS)
+    rows = None
+
+    try:
+        import openpyxl
+
+        workbook = openpyxl.load_workbook(path, read_only=True)
+        rows = max(workbook.worksheets[0].max_row - 1, 0)
+        workbook.close()
+    except Exception:
+        pass
+
+    return from_frame(df, rows=rows)
+
+
+def describe_schema(schema):
+    if schema is None:
+        return ''
+
+    description = f'The file contains the following columns: {", ".join(schema["columns"])}'
+    if schema['rows'] is not None:
+        description += f'\nIt has {"about " if schema["rows_estimated"] else ""}{schema["rows"]:,} rows.'
+    return description
@@ -0,0 +1,45 @@
+# Production server for the webapp: gunicorn with several threaded worker processes
+from gunicorn.app.base import BaseApplication
+
+import gpt_code_ui.startup as startup
+
+try:
+    from prometheus_client import multiprocess
+except ImportError:
+    multiprocess = None
+
+
+class WebappServer(BaseApplication):
+    """Runs the webapp in `workers` processes with `threads` threads each.
+
+    Every worker imports the webapp itself, after the fork, so threads and
+    connections aren't shared between them.
+    """
+
+    def __init__(self, port, workers, threads, events=None):
+        self.options = {
+            "bind": "0.0.0.0:%d" % port,
+            "workers": workers,
+            "threads": threads,
+            "worker_class": "gthread",
+            # Event streams never end, don't wait for them on shutdown
+            "graceful_timeout": 5,
+            "loglevel": "warning",
+            "when_ready": lambda server: startup.report(events, "webapp", "listening"),
+            "child_exit": self.child_exit,
+        }
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from gpt_code_ui.webapp.main import app
+        return app
+
+    @staticmethod
+    def child_exit(server, worker):
+        # Drops the worker's live gauges from the metrics the other workers serve
+        if multiprocess is not None:
+            multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,300 @@
+# Chunked, resumable uploads into the workspace
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows
+
+# Bytes copied from the request to disk at a time
+COPY_BUFFER_SIZE = 64 * 1024
+
+# ioctl that makes a file share the blocks of another, copy-on-write (Btrfs, XFS)
+FICLONE = 0x40049409
+
+
+def reflink(source, destination):
+    """Create `destination` sharing the blocks of `source`, raise OSError where that isn't supported.
+
+    Unlike a hardlink it's a file of its own, writing to either leaves the other as it was.
+    """
+    if fcntl is None or not hasattr(fcntl, "ioctl"):
+        raise OSError("Reflinks aren't supported")
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(destination)
+            raise
+
+
+@contextlib.contextmanager
+def file_lock(f):
+    """Hold an exclusive lock on the open file `f` against other processes, a no-op without fcntl."""
+    with f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+
+class UploadStore:
+    """Receives files as a sequence of chunks that are streamed to disk.
+
+    An upload is started with `init`, its chunks are sent in order with
+    `put_chunk` and it's moved into the workspace by `complete`. The state of
+    every upload is kept next to its partial file, so an interrupted upload
+    is resumed from the last acknowledged chunk, even after a restart.
+
+    Completed files are hashed while they are written. A file with the same
+    content as an earlier upload shares its blocks through a reflink instead
+    of being stored twice, where the file system supports it.
+
+    Several processes can share the directory, the chunks of an upload may
+    arrive at any of them.
+    """
+
+    def __init__(self, directory, chunk_size=8 * 1024 * 1024, max_chunk_size=64 * 1024 * 1024, expiry=24 * 3600):
+        self.directory = directory
+        self.state_directory = os.path.join(directory, ".uploads")
+        self.chunk_size = chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.expiry = expiry
+
+        self.lock = threading.Lock()
+        self.upload_locks = {}  # upload id -> lock serializing its chunks
+        self.hashers = {}  # upload id -> (bytes hashed, running hash of the received bytes)
+
+        os.makedirs(self.state_directory, exist_ok=True)
+
+    def state_path(self, upload_id):
+        return os.path.join(self.state_directory, upload_id + ".json")
+
+    def part_path(self, upload_id):
+        return os.path.join(self.state_directory, upload_id + ".part")
+
+    def index_path(self):
+        return os.path.join(self.state_directory, "index.json")
+
+    @contextlib.contextmanager
+    def upload_lock(self, upload_id):
+        with self.lock:
+            lock = self.upload_locks.setdefault(upload_id, threading.Lock())
+        with lock:
+            # Other processes might be working on the upload too
+            self.status(upload_id)  # 404 for unknown ids, before they go into a path
+            try:
+                part = open(self.part_path(upload_id), "rb")
+            except FileNotFoundError:
+                raise UploadError("Unknown upload", status=404)
+            with file_lock(part):
+                yield
+
+    def init(self, filename, size, chunk_size=None):
+        filename = os.path.basename(filename or "")
+        if filename in ("", ".", ".."):
+            raise UploadError("No selected file")
+        try:
+            size = int(size)
+        except (TypeError, ValueError):
+            raise UploadError("The file size is required")
+        if size < 0:
+            raise UploadError("The file size is required")
+
+        try:
+            chunk_size = min(int(chunk_size or self.chunk_size), self.max_chunk_size)
+        except (TypeError, ValueError):
+            raise UploadError("Invalid chunk size")
+        if chunk_size <= 0:
+            raise UploadError("Invalid chunk size")
+
+        self.remove_expired()
+
+        state = {
+            "id": uuid.uuid4().hex,
+            "filename": filename,
+            "size": size,
+            "chunkSize": chunk_size,
+            "chunks": max(1, -(-size // chunk_size)),
+            "received": 0,  # number of acknowledged chunks
+            "bytes": 0,
+        }
+        open(self.part_path(state["id"]), "wb").close()
+        self.save_state(state)
+        self.hashers[state["id"]] = (0, hashlib.sha256())
+        return state
+
+    def status(self, upload_id):
+        if not re.fullmatch(r"[0-9a-f]{32}", upload_id):
+            raise UploadError("Unknown upload", status=404)
+        try:
+            with open(self.state_path(upload_id), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            raise UploadError("Unknown upload", status=404)
+
+    def save_state(self, state):
+        path = self.state_path(state["id"])
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+
+    def hasher(self, state):
+        hashed, hasher = self.hashers.get(state["id"], (None, None))
+        if hashed != state["bytes"]:
+            # The running hash didn't survive a restart or another process received
+            # the latest chunks, rebuild it from what was acknowledged
+            hasher = hashlib.sha256()
+            with open(self.part_path(state["id"]), "rb") as f:
+                remaining = state["bytes"]
+                while remaining > 0:
+                    data = f.read(min(COPY_BUFFER_SIZE, remaining))
+                    if not data:
+                        break
+                    hasher.update(data)
+                    remaining -= len(data)
+            self.hashers[state["id"]] = (state["bytes"], hasher)
+        return hasher
+
+    def put_chunk(self, upload_id, index, stream):
+        """Append chunk `index` read from the file-like `stream`.
+
+        Chunks that were already acknowledged are ignored, so a client can
+        safely resend the chunk it didn't get an answer for.
+        """
+        with self.upload_lock(upload_id):
+            state = self.status(upload_id)
+
+            if index < state["received"]:
+                return state
+            if index != state["received"] or index >= state["chunks"]:
+                raise UploadError("Chunks must be sent in order", status=409, expected=state["received"])
+
+            offset = index * state["chunkSize"]
+            expected = min(state["chunkSize"], state["size"] - offset)
+            hasher = self.hasher(state).copy()
+            written = 0
+
+            with open(self.part_path(upload_id), "r+b") as f:
+                # Drops whatever a broken earlier attempt at this chunk left behind
+                f.truncate(offset)
+                f.seek(offset)
+
+                while True:
+                    data = stream.read(COPY_BUFFER_SIZE)
+                    if not data:
+                        break
+                    written += len(data)
+                    if written > expected:
+                        f.truncate(offset)
+                        raise UploadError("Chunk is larger than announced", expected=expected)
+                    f.write(data)
+                    hasher.update(data)
+
+            if written != expected:
+                raise UploadError("Chunk is incomplete", expected=expected, received=written)
+
+            self.hashers[upload_id] = (state["bytes"] + written, hasher)
+            state["received"] += 1
+            state["bytes"] += written
+            self.save_state(state)
+            return state
+
+    def complete(self, upload_id):
+        """Move a fully received upload into the workspace and return its path and hash."""
+        with self.upload_lock(upload_id):
+            state = self.status(upload_id)
+            if state["received"] < state["chunks"]:
+                raise UploadError("Upload is incomplete", status=409, expected=state["received"])
+
+            digest = self.hasher(state).hexdigest()
+            target = os.path.join(self.directory, state["filename"])
+            part_path = self.part_path(upload_id)
+
+            with self.lock, file_lock(open(self.index_path() + ".lock", "ab")):
+                existing = self.find_duplicate(digest, state["size"])
+                deduplicated = False
+                if existing is not None and os.path.abspath(existing) != os.path.abspath(target):
+                    # Not a hardlink, the kernel may rewrite either file in place.
+                    # Cloned next to the target first, so the target is replaced atomically
+                    link_path = part_path + ".link"
+                    try:
+                        reflink(existing, link_path)
+                        os.replace(link_path, target)
+                        os.remove(part_path)
+                        deduplicated = True
+                    except OSError:
+                        pass  # no reflinks on this file system, keep the copy
+                if not deduplicated:
+                    os.replace(part_path, target)
+                self.remember(digest, target)
+
+            os.remove(self.state_path(upload_id))
+            self.hashers.pop(upload_id, None)
+            with self.lock:
+                self.upload_locks.pop(upload_id, None)
+
+            return target, digest, deduplicated
+
+    def load_index(self):
+        try:
+            with open(self.index_path(), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_index(self, index):
+        tmp_path = "%s.%d.tmp" % (self.index_path(), os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path())
+
+    def find_duplicate(self, digest, size):
+        entry = self.load_index().get(digest)
+        if entry is None:
+            return None
+
+        # Only trust the entry while the file is unchanged since it was hashed
+        try:
+            stat = os.stat(entry["path"])
+        except OSError:
+            return None
+        if stat.st_size != size or stat.st_mtime_ns != entry["mtime_ns"] or stat.st_ino != entry["ino"]:
+            return None
+        return entry["path"]
+
+    def remember(self, digest, path):
+        stat = os.stat(path)
+        index = self.load_index()
+        index[digest] = {"path": path, "mtime_ns": stat.st_mtime_ns, "ino": stat.st_ino}
+        self.save_index(index)
+
+    def remove_expired(self):
+        now = time.time()
+        for entry in os.scandir(self.state_directory):
+            upload_id, ext = os.path.splitext(entry.name)
+            if ext != ".json" or entry.name == "index.json":
+                continue
+            try:
+                if now - entry.stat().st_mtime < self.expiry:
+                    continue
+                os.remove(entry.path)
+                os.remove(self.part_path(upload_id))
+            except OSError:
+                pass
+            self.hashers.pop(upload_id, None)
@@ -0,0 +1,197 @@
+# Index of the files in the workspace, kept current without listing it on every request
+import os
+import time
+import fnmatch
+import mimetypes
+import threading
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+from gpt_code_ui.webapp.schema import inspect_schema
+
+SORT_KEYS = {
+    'name': lambda entry: entry['name'],
+    'mtime': lambda entry: entry['mtime'],
+    'size': lambda entry: entry['size'],
+}
+
+
+def is_hidden(name):
+    return name.startswith('.')
+
+
+class WorkspaceIndex:
+    """Lists the workspace's files with their size, modification time and type.
+
+    With inotify (the optional inotify_simple package on Linux), changes are
+    picked up from the pending events whenever the index is queried, so only
+    changed files are looked at again. Elsewhere the workspace is rescanned,
+    at most every `scan_interval` seconds. Hidden files and directories are
+    left out.
+    """
+
+    WATCH_FLAGS = 0 if INotify is None else (
+        flags.CREATE | flags.CLOSE_WRITE | flags.DELETE | flags.MOVED_FROM
+        | flags.MOVED_TO | flags.ATTRIB | flags.DELETE_SELF
+    )
+
+    def __init__(self, directory, scan_interval=2.0, use_inotify=True):
+        self.directory = os.path.abspath(directory)
+        self.scan_interval = scan_interval
+
+        self.lock = threading.Lock()
+        self.entries = {}  # relative path -> file entry
+        self.last_scan = None
+
+        self.inotify = None
+        self.watches = {}  # watch descriptor -> relative directory
+        if use_inotify and INotify is not None:
+            try:
+                self.inotify = INotify()
+            except OSError:
+                self.inotify = None
+
+    def make_entry(self, name, stat):
+        mimetype, _ = mimetypes.guess_type(name)
+        return {
+            'name': name,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'type': mimetype or 'application/octet-stream',
+        }
+
+    def watch(self, relative_directory):
+        try:
+            wd = self.inotify.add_watch(os.path.join(self.directory, relative_directory), self.WATCH_FLAGS)
+        except OSError:
+            return
+        self.watches[wd] = relative_directory
+
+    def scan(self, relative_directory=''):
+        """Add the files below `relative_directory`, return the set of their names."""
+        found = set()
+        pending = [relative_directory]
+
+        while pending:
+            current = pending.pop()
+            if self.inotify is not None:
+                self.watch(current)
+            try:
+                iterator = os.scandir(os.path.join(self.directory, current))
+            except OSError:
+                continue
+
+            with iterator:
+                for entry in iterator:
+                    if is_hidden(entry.name):
+                        continue
+                    name = os.path.join(current, entry.name)
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(name)
+                        elif entry.is_file():
+                            self.entries[name] = self.make_entry(name, entry.stat())
+                            found.add(name)
+                    except OSError:
+                        pass
+
+        return found
+
+    def full_scan(self):
+        if self.inotify is not None:
+            for wd in list(self.watches):
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    pass
+            self.watches.clear()
+
+        previous = set(self.entries)
+        found = self.scan()
+        for name in previous - found:
+            del self.entries[name]
+        self.last_scan = time.monotonic()
+
+    def remove_below(self, relative_directory):
+        prefix = relative_directory + os.sep
+        for name in [name for name in self.entries if name.startswith(prefix)]:
+            del self.entries[name]
+        for wd, watched in list(self.watches.items()):
+            if watched == relative_directory or watched.startswith(prefix):
+                del self.watches[wd]
+
+    def update(self, name):
+        try:
+            stat = os.stat(os.path.join(self.directory, name))
+        except OSError:
+            self.entries.pop(name, None)
+            return
+        self.entries[name] = self.make_entry(name, stat)
+
+    def apply_events(self):
+        for event in self.inotify.read(timeout=0):
+            if event.mask & flags.Q_OVERFLOW:
+                # Events were lost, only a full scan tells what changed
+                self.full_scan()
+                return
+
+            relative_directory = self.watches.get(event.wd)
+            if relative_directory is None:
+                continue
+            if event.mask & (flags.DELETE_SELF | flags.IGNORED):
+                self.remove_below(relative_directory)
+                continue
+            if not event.name or is_hidden(event.name):
+                continue
+
+            name = os.path.join(relative_directory, event.name)
+            if event.mask & flags.ISDIR:
+                if event.mask & (flags.DELETE | flags.MOVED_FROM):
+                    self.remove_below(name)
+                elif event.mask & (flags.CREATE | flags.MOVED_TO):
+                    self.scan(name)
+            elif event.mask & (flags.DELETE | flags.MOVED_FROM):
+                self.entries.pop(name, None)
+            else:
+                self.update(name)
+
+    def refresh(self):
+        with self.lock:
+            if self.last_scan is None:
+                self.full_scan()
+            elif self.inotify is not None:
+                self.apply_events()
+            elif time.monotonic() - self.last_scan >= self.scan_interval:
+                self.full_scan()
+
+    def list(self, offset=0, limit=100, pattern=None, file_type=None, sort='name', descending=False, with_schema=True):
+        """Return the total number of matching files and one page of them.
+
+        `pattern` is a glob matched against the relative path, `file_type` a
+        prefix of the mimetype, e.g. "text/" or "image/png".
+        """
+        self.refresh()
+
+        with self.lock:
+            entries = list(self.entries.values())
+
+        if pattern:
+            entries = [entry for entry in entries if fnmatch.fnmatch(entry['name'], pattern)]
+        if file_type:
+            entries = [entry for entry in entries if entry['type'].startswith(file_type)]
+
+        entries.sort(key=SORT_KEYS.get(sort, SORT_KEYS['name']), reverse=descending)
+        page = [dict(entry) for entry in entries[offset:offset + limit]]
+
+        if with_schema:
+            # Only for the page, schemas are cached until a file changes
+            for entry in page:
+                try:
+                    entry['schema'] = inspect_schema(os.path.join(self.directory, entry['name']))
+                except OSError:
+                    entry['schema'] = None
+
+        return len(entries), page
@@ -0,0 +1,391 @@
+"""End-to-end latency benchmark of the whole gpt-code-ui stack.
+
+Starts `gpt_code_ui.main` (webapp, kernel program, kernel manager and
+kernel) in a temporary directory, with a local stub in place of the OpenAI
+API, and measures:
+
+- prompt to code, through /generate and to the code event of /generate-stream
+- execute to first and to last output, read from the result stream
+- image round trip, from execute to the fetched image bytes
+- upload and inspection of CSV files of several sizes
+
+Percentiles are written as JSON. With --baseline, they are compared against
+an earlier result and the script exits with 1 if a p95 got slower than
+--tolerance allows. Run from the repository root:
+
+    python scripts/benchmark_e2e.py --output benchmark.json
+    python scripts/benchmark_e2e.py --baseline benchmark.json
+"""
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+SESSION = "benchmark"
+
+STUB_ANSWER = "Here is the code.\n```python\nprint('hello from the stub')\n```\nThat's it."
+
+PRINT_CODE = "for i in range(%d):\n    print(i)"
+
+IMAGE_CODE = "import matplotlib.pyplot as plt\nplt.plot([1, 3, 2])\nplt.show()"
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    """Answers chat completions like the OpenAI API, streamed or not, always with STUB_ANSWER."""
+
+    protocol_version = "HTTP/1.1"
+    token_delay = 0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+        if not body.get("stream"):
+            data = json.dumps({
+                "id": "stub", "object": "chat.completion", "created": 0, "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": STUB_ANSWER}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        # A few characters per chunk, roughly like tokens
+        for i in range(0, len(STUB_ANSWER), 4):
+            chunk = json.dumps({
+                "id": "stub", "object": "chat.completion.chunk", "created": 0, "model": body.get("model"),
+                "choices": [{"index": 0, "delta": {"content": STUB_ANSWER[i:i + 4]}, "finish_reason": None}],
+            })
+            self.write_chunk(("data: %s\n\n" % chunk).encode("utf-8"))
+            if self.token_delay:
+                time.sleep(self.token_delay)
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summarize(seconds):
+    milliseconds = [s * 1000 for s in seconds]
+    return {
+        "n": len(milliseconds),
+        "p50": round(percentile(milliseconds, 50), 3),
+        "p95": round(percentile(milliseconds, 95), 3),
+        "p99": round(percentile(milliseconds, 99), 3),
+        "mean": round(sum(milliseconds) / len(milliseconds), 3),
+    }
+
+
+class Stack:
+    """The gpt-code-ui processes, started in their own process group."""
+
+    def __init__(self, directory, llm_port, transport):
+        self.directory = directory
+        self.web_port = free_port()
+        self.env = dict(
+            os.environ,
+            PYTHONPATH=os.pathsep.join(filter(None, [os.path.abspath(REPO_ROOT), os.environ.get("PYTHONPATH")])),
+            WEB_PORT=str(self.web_port),
+            API_PORT=str(free_port()),
+            SNAKEMQ_PORT=str(free_port()),
+            OPENAI_API_KEY="stub",
+            OPENAI_API_BASE="http://127.0.0.1:%d/v1" % llm_port,
+            OPENAI_API_TYPE="open_ai",
+            BROWSER="true",  # webbrowser.open runs `true`
+        )
+        if transport:
+            self.env["KERNEL_TRANSPORT"] = transport
+        self.process = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.web_port
+
+    def start(self, timeout=120):
+        started = time.monotonic()
+        self.log = open(os.path.join(self.directory, "stack.log"), "wb")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "gpt_code_ui.main"],
+            cwd=self.directory, env=self.env, stdout=self.log, stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+
+        while time.monotonic() - started < timeout:
+            if self.process.poll() is not None:
+                raise RuntimeError("gpt_code_ui.main exited, see %s" % self.log.name)
+            try:
+                if requests.get(self.url + "/api/kernels", timeout=1).ok:
+                    return time.monotonic() - started
+            except requests.RequestException:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError("gpt_code_ui.main didn't start within %d seconds" % timeout)
+
+    def stop(self):
+        if self.process is None:
+            return
+        # SIGINT lets the launcher clean up the kernels, whatever is left is killed
+        try:
+            os.killpg(self.process.pid, signal.SIGINT)
+            self.process.wait(10)
+        except (ProcessLookupError, subprocess.TimeoutExpired):
+            pass
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+        self.log.close()
+
+
+class ResultStream:
+    """Reads the session's result stream and timestamps every result as it arrives."""
+
+    def __init__(self, url):
+        self.results = queue.Queue()
+        self.opened = threading.Event()
+        self.response = requests.get(url + "/api/stream", params={"session": SESSION}, stream=True, timeout=(5, None))
+        threading.Thread(target=self.read, daemon=True).start()
+
+    def read(self):
+        self.opened.set()
+        try:
+            for line in self.response.iter_lines(chunk_size=None):
+                if line.startswith(b"data: "):
+                    self.results.put((time.monotonic(), json.loads(line[6:])))
+        except requests.RequestException:
+            pass  # the stack was stopped
+
+    def wait_for(self, execution_id, timeout=120):
+        """Return the (time, result) pairs of an execution, up to its done status."""
+        collected = []
+        deadline = time.monotonic() + timeout
+        while True:
+            received, result = self.results.get(timeout=max(0, deadline - time.monotonic()))
+            if result.get("execution_id") != execution_id:
+                continue
+            if result["type"] == "status":
+                if result["value"] == "done":
+                    return collected
+                continue
+            collected.append((received, result))
+
+
+def execute(stack, stream, code):
+    started = time.monotonic()
+    response = requests.post(stack.url + "/api/api", params={"session": SESSION}, json={"command": code})
+    response.raise_for_status()
+    return started, stream.wait_for(response.json()["execution_id"])
+
+
+def measure_generate(stack, iterations):
+    blocking, streamed = [], []
+    for i in range(iterations):
+        started = time.monotonic()
+        response = requests.post(stack.url + "/generate", json={"prompt": "benchmark %d" % i, "model": "gpt-3.5-turbo", "noCache": True})
+        if response.json().get("code") is None:
+            raise RuntimeError("/generate returned no code: %s" % response.text)
+        blocking.append(time.monotonic() - started)
+
+        started = time.monotonic()
+        with requests.post(stack.url + "/generate-stream", json={"prompt": "benchmark %d" % i, "model": "gpt-3.5-turbo", "noCache": True}, stream=True) as response:
+            for line in response.iter_lines():
+                if line and json.loads(line)["type"] == "code":
+                    streamed.append(time.monotonic() - started)
+                    break
+    return {"prompt_to_code": blocking, "prompt_to_code_streamed": streamed}
+
+
+def measure_execute(stack, stream, iterations, lines):
+    first, last = [], []
+    for _ in range(iterations):
+        started, outputs = execute(stack, stream, PRINT_CODE % lines)
+        if not outputs:
+            raise RuntimeError("Execution produced no output")
+        first.append(outputs[0][0] - started)
+        last.append(outputs[-1][0] - started)
+    return {"execute_to_first_output": first, "execute_to_last_output": last}
+
+
+def measure_images(stack, stream, iterations):
+    round_trips = []
+    for _ in range(iterations):
+        started, outputs = execute(stack, stream, IMAGE_CODE)
+        images = [result for _, result in outputs if result["type"].startswith("image/")]
+        if not images:
+            raise RuntimeError("Execution produced no image")
+
+        # Blobs are fetched like the browser does, inline images are already there
+        if images[0].get("blob"):
+            requests.get(stack.url + "/blobs/" + images[0]["value"]).raise_for_status()
+        round_trips.append(time.monotonic() - started)
+    return {"image_round_trip": round_trips}
+
+
+def write_csv(path, size):
+    row = "1234,some text,3.14159,2023-07-01\n"
+    with open(path, "w") as f:
+        f.write("id,name,value,date\n")
+        f.write(row * max(1, size // len(row)))
+
+
+def measure_uploads(stack, directory, iterations, sizes):
+    timings = {}
+    for size in sizes:
+        path = os.path.join(directory, "benchmark_%d.csv" % size)
+        write_csv(path, size)
+
+        key = "upload_inspect_%s" % format_size(size)
+        timings[key] = []
+        for i in range(iterations):
+            with open(path, "rb") as f:
+                started = time.monotonic()
+                # A new name every time, so the schema isn't served from the cache
+                response = requests.post(stack.url + "/upload", files={"file": ("upload_%d_%d.csv" % (size, i), f)})
+                response.raise_for_status()
+                timings[key].append(time.monotonic() - started)
+        os.remove(path)
+    return timings
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1000 or unit == "GB":
+            return "%g%s" % (size, unit)
+        size /= 1000
+
+
+def compare(results, baseline, tolerance):
+    """Return the relative change of every percentile and the p95s that got slower than `tolerance`."""
+    changes, regressions = {}, []
+    for name, current in results["metrics"].items():
+        previous = baseline.get("metrics", {}).get(name)
+        if previous is None:
+            continue
+        changes[name] = {
+            p: round(current[p] / previous[p] - 1, 3) if previous[p] else None
+            for p in ("p50", "p95", "p99")
+        }
+        if changes[name]["p95"] is not None and changes[name]["p95"] > tolerance:
+            regressions.append(name)
+    return changes, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2, help="iterations per measurement that aren't recorded")
+    parser.add_argument("--lines", type=int, default=100, help="lines printed by the execute benchmark")
+    parser.add_argument("--sizes", default="100000,1000000,10000000", help="CSV upload sizes in bytes, comma separated")
+    parser.add_argument("--token-delay", type=float, default=0, help="seconds the stub LLM waits between chunks")
+    parser.add_argument("--transport", help="KERNEL_TRANSPORT of the stack, its default if not given")
+    parser.add_argument("--output", help="file to write the results to, stdout if not given")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative p95 slowdown against the baseline")
+    args = parser.parse_args()
+
+    StubLLMHandler.token_delay = args.token_delay
+    llm = ThreadingHTTPServer(("127.0.0.1", 0), StubLLMHandler)
+    threading.Thread(target=llm.serve_forever, daemon=True).start()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    samples = {}
+
+    def record(measured):
+        for name, values in measured.items():
+            samples.setdefault(name, []).extend(values)
+
+    with tempfile.TemporaryDirectory(prefix="gpt_code_ui_benchmark_") as directory:
+        stack = Stack(directory, llm.server_address[1], args.transport)
+        try:
+            startup = stack.start()
+            stream = ResultStream(stack.url)
+            stream.opened.wait(10)
+
+            # The session's kernel is assigned by the first request, and reports ready
+            execute(stack, stream, "pass")
+
+            measure_generate(stack, args.warmup)
+            record(measure_generate(stack, args.iterations))
+
+            measure_execute(stack, stream, args.warmup, args.lines)
+            record(measure_execute(stack, stream, args.iterations, args.lines))
+
+            measure_images(stack, stream, args.warmup)
+            record(measure_images(stack, stream, args.iterations))
+
+            record(measure_uploads(stack, directory, args.iterations, sizes))
+        finally:
+            stack.stop()
+            llm.shutdown()
+
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "iterations": args.iterations,
+            "lines": args.lines,
+            "transport": args.transport,
+            "startup_seconds": round(startup, 3),
+        },
+        "unit": "ms",
+        "metrics": {name: summarize(values) for name, values in samples.items()},
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            changes, regressions = compare(results, json.load(f), args.tolerance)
+        results["comparison"] = {"baseline": args.baseline, "changes": changes, "regressions": regressions}
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if regressions:
+        print("Slower than the baseline: %s" % ", ".join(regressions), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
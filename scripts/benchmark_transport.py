@@ -0,0 +1,143 @@
+"""Compare the transports between the kernel program and the kernel managers.
+
+A child process connects like a kernel manager does and sends output
+messages to the listening side, first one at a time as ping-pongs for the
+round trip latency, timed by the child from sending the ping until the pong
+is back, then as a flood for the throughput and the one way latency under
+load. Run from the repository root:
+
+    python scripts/benchmark_transport.py --messages 20000 --payload 200
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import gpt_code_ui.kernel_program.config as config  # noqa: E402
+from gpt_code_ui.kernel_program.transport import SnakeMQTransport, ZMQTransport  # noqa: E402
+
+PEER = "kernel_manager-bench"
+
+
+def make_transport(name, ident, init_type, address):
+    if name == "snakemq":
+        # The snakemq port is read from the environment
+        return SnakeMQTransport(ident, init_type)
+    return ZMQTransport(ident, init_type, address=address)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summarize(latencies):
+    return {
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(max(latencies) * 1000, 3),
+    }
+
+
+def run_peer(name, address, payload_size, round_trips, messages):
+    transport = make_transport(name, PEER, "connect", address)
+    payload = "x" * payload_size
+    pongs = threading.Semaphore(0)
+    round_trip_times = []
+
+    def on_recv(ident, message):
+        if message["type"] == "pong":
+            round_trip_times.append(time.monotonic() - message["sent"])
+            pongs.release()
+        elif message["type"] == "flood":
+            # time.monotonic is system wide on Linux, so it's comparable across processes
+            for i in range(messages):
+                transport.send(config.IDENT_MAIN, {"type": "message", "value": payload, "sent": time.monotonic()})
+            transport.send(config.IDENT_MAIN, {"type": "end"})
+
+    transport.on_message(on_recv)
+    threading.Thread(target=transport.loop, daemon=True).start()
+
+    transport.send(config.IDENT_MAIN, {"type": "status", "value": "ready"})
+    for i in range(round_trips):
+        transport.send(config.IDENT_MAIN, {"type": "ping", "value": payload, "sent": time.monotonic()})
+        pongs.acquire()
+    transport.send(config.IDENT_MAIN, {"type": "round_trips", "value": round_trip_times})
+
+    # Keeps the process, and so the loop thread, alive until the parent is done
+    time.sleep(3600)
+
+
+def benchmark(name, payload_size, round_trips, messages):
+    address = "ipc://" + os.path.join(tempfile.gettempdir(), "gpt_code_ui_benchmark.sock")
+    transport = make_transport(name, config.IDENT_MAIN, "listen", address)
+
+    ready = threading.Event()
+    finished = threading.Event()
+    round_trip_times = []
+    one_way = []
+    flood = {}
+
+    def on_recv(ident, message):
+        if message["type"] == "status":
+            ready.set()
+        elif message["type"] == "ping":
+            transport.send(ident, {"type": "pong", "sent": message["sent"]})
+        elif message["type"] == "round_trips":
+            # Measured by the peer, which got every pong back
+            round_trip_times.extend(message["value"])
+            flood["started"] = time.monotonic()
+            transport.send(ident, {"type": "flood"})
+        elif message["type"] == "message":
+            one_way.append(time.monotonic() - message["sent"])
+        elif message["type"] == "end":
+            flood["finished"] = time.monotonic()
+            finished.set()
+
+    transport.on_message(on_recv)
+    threading.Thread(target=transport.loop, daemon=True).start()
+
+    # Spawned, neither zmq contexts nor the loop threads survive a fork
+    peer = multiprocessing.get_context("spawn").Process(target=run_peer, args=(name, address, payload_size, round_trips, messages))
+    peer.start()
+    try:
+        if not ready.wait(30) or not finished.wait(600):
+            raise RuntimeError("%s benchmark timed out" % name)
+    finally:
+        peer.kill()
+        peer.join()
+        transport.stop()
+
+    return {
+        "transport": name,
+        "payload_bytes": payload_size,
+        "round_trip": summarize(round_trip_times),
+        "messages": len(one_way),
+        "messages_per_second": round(len(one_way) / (flood["finished"] - flood["started"])),
+        "one_way_under_load": summarize(one_way),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--transports", default="snakemq,zmq", help="comma separated")
+    parser.add_argument("--messages", type=int, default=20000, help="messages in the flood")
+    parser.add_argument("--round-trips", type=int, default=1000)
+    parser.add_argument("--payload", type=int, default=200, help="characters per message")
+    args = parser.parse_args()
+
+    results = [
+        benchmark(name, args.payload, args.round_trips, args.messages)
+        for name in args.transports.split(",")
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
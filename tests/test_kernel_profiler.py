@@ -0,0 +1,23 @@
+import sys
+import cProfile
+
+from gpt_code_ui.kernel_program.kernel_profiler import hot_functions
+
+
+def test_hot_functions_skip_import_machinery_and_builtins(tmp_path, monkeypatch):
+    # A module that wasn't imported yet, so the import machinery runs
+    (tmp_path / "profiled_module.py").write_text("def work():\n    return sum(i * i for i in range(100000))\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(sys.modules, "profiled_module", raising=False)
+
+    cell = compile("import profiled_module\nprofiled_module.work()\n", "<cell>", "exec")
+    profile = cProfile.Profile()
+    profile.enable()
+    exec(cell, {})
+    profile.disable()
+
+    functions = hot_functions(profile, top=50)
+    files = {f["file"] for f in functions}
+    assert not [f for f in files if f == "~" or f.startswith("<frozen ")]
+    assert functions[0]["file"] == "<cell>"
+    assert "work" in [f["function"] for f in functions]